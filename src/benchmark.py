@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+'''
+Benchmark the stages of the flownav pipeline on synthetic expanding scenes
+and check the estimated scales against the ground truth.
+
+    python benchmark.py --sizes 240x320,480x640 --patches 4,16,64 -o report.json
+'''
+import argparse
+import json
+import platform
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from common import StageTimer
+from framebuffer import FrameHistory
+from features import FeatureEngine, TiledDetector, ENGINES, DEFAULT_ENGINE
+from matching import DescriptorMatcher, MATCHERS
+import scale_matching as smatch
+from synthetic import ExpandingScene
+from tracking import ExpansionTracker, LAST_DAY
+
+SCALE_TOLERANCE = 2./(2*smatch.SEARCH_RES) # two steps of the scale search
+MIN_ACCURACY = 0.8 # fraction of expansions within tolerance for a run to pass
+
+STAGES = ('detect','match','filter','expansion','history')
+
+
+def runSequence(scene, nframes, detector, matcher, search='exhaustive', predict=False, pool=None):
+    '''
+    Track nframes frames of scene and time every stage. Returns the stage
+    timer, the keypoint and match counts per frame and the absolute scale
+    error of every expansion with whether it lies on the background.
+    '''
+    h, w = scene.shape
+    roi = np.zeros(scene.shape, np.uint8)
+    roi[h//4:-(h//4), w//4:-(w//4)] = True
+
+    history = FrameHistory(historysize=LAST_DAY+1)
+    tracker = ExpansionTracker(detector, matcher, roi, history, 'L2', search=search, predict=predict, pool=pool
+                               , ratio=detector.ratio, maxdist=detector.maxdist)
+    timer = StageTimer()
+
+    frame = scene.frame(0)
+    history.push(frame, scene.time(0))
+    tracker.reset(frame, scene.time(0))
+
+    nkeypoints, nmatches, errors, onbackground = [], [], [], []
+    for i in range(1, nframes):
+        frame = scene.frame(i)
+        t = scene.time(i)
+        history.push(frame, t)
+
+        with timer.time('detect'):
+            trainKP, tdesc = tracker.detect(frame)
+        t0 = time.time()
+        matches = tracker.match(trainKP, tdesc)
+        timer.add('match', matcher.matchTime)
+        timer.add('filter', time.time()-t0-matcher.matchTime)
+        nkeypoints.append(len(trainKP))
+        nmatches.append(len(matches))
+        with timer.time('expansion'):
+            matches, kpscales = tracker.estimateExpansion(matches)
+        with timer.time('history'):
+            expansions = tracker.update(matches, kpscales, t)
+
+        for e in expansions:
+            a, b = scene.frameIndex(e['t0']), scene.frameIndex(e['t1'])
+            errors.append(abs(e['scale'] - scene.trueScale((e['x'],e['y']), a, b)))
+            onbackground.append(scene.patchAt((e['x'],e['y']), b) is None)
+
+    return timer, nkeypoints, nmatches, np.array(errors), np.array(onbackground, np.bool_)
+
+
+def summarize(shape, npatches, nframes, timer, nkeypoints, nmatches, errors, onbackground
+              , minaccuracy=MIN_ACCURACY):
+    within = errors < SCALE_TOLERANCE
+    latencies = timer.summary()['stages']
+    return dict(shape=list(shape), patches=npatches, frames=nframes
+                , keypoints=float(np.mean(nkeypoints)), matches=float(np.mean(nmatches))
+                , timing_ms=dict((stage, dict(latencies[stage]
+                                              , mean=1000*timer.total[stage]/timer.count[stage]
+                                              , total=1000*timer.total[stage]))
+                                 for stage in STAGES)
+                , expansions=len(errors), background_expansions=int(onbackground.sum())
+                , scale_error=dict(mean=float(errors.mean()) if errors.size else None
+                                   , median=float(np.median(errors)) if errors.size else None
+                                   , max=float(errors.max()) if errors.size else None)
+                , accuracy=float(within.mean()) if errors.size else None
+                , passed=bool(errors.size and within.mean() >= minaccuracy))
+
+
+def parseSize(s):
+    h, w = map(int, s.lower().split('x'))
+    return h, w
+
+
+# ==========================================================
+# process options and set up defaults
+# ==========================================================
+parser = argparse.ArgumentParser(usage="benchmark.py [options]")
+parser.add_argument("--sizes", dest="sizes", default="240x320,480x640"
+                    , help="Comma separated frame sizes as HxW. (%(default)s)")
+
+parser.add_argument("--patches", dest="patches", default="4,16,64"
+                    , help="Comma separated numbers of expanding patches per scene. (%(default)s)")
+
+parser.add_argument("--frames", dest="frames", type=int, default=30
+                    , help="Frames per sequence. (%(default)s)")
+
+parser.add_argument("--seed", dest="seed", type=int, default=0
+                    , help="Seed of the synthetic scenes. (%(default)s)")
+
+parser.add_argument("--features", dest="features", default=DEFAULT_ENGINE, choices=ENGINES.keys()
+                    , help="Feature detector and descriptor. (%(default)s)")
+
+parser.add_argument("--tiles", dest="tiles", default=None
+                    , help="Detect keypoints in parallel over a grid of ROWSxCOLS tiles of the ROI. (off)")
+
+parser.add_argument("--tile-features", dest="tilefeatures", type=int, default=0
+                    , help="Keep at most this many of the strongest keypoints per tile, 0 for all. (%(default)s)")
+
+parser.add_argument("--threshold", dest="threshold", type=float, default=None
+                    , help="Set the detection threshold. (engine default)")
+
+parser.add_argument("--matcher", dest="matcher", default="bf", choices=MATCHERS
+                    , help="Descriptor matcher. (%(default)s)")
+
+parser.add_argument("--match-radius", dest="matchradius", type=float, default=None
+                    , help="Only match keypoints within this many pixels of each other. (off)")
+
+parser.add_argument("--scale-search", dest="scalesearch", default="exhaustive"
+                    , choices=("exhaustive","coarse")
+                    , help="Search every template scale or search coarse to fine. (%(default)s)")
+
+parser.add_argument("--predict-scale", dest="predictscale", action="store_true", default=False
+                    , help="Search mature tracks only around their predicted scale. (%(default)s)")
+
+parser.add_argument("--workers", dest="workers", type=int, default=0
+                    , help="Estimate expansion in this many worker processes. (%(default)s)")
+
+parser.add_argument("--min-accuracy", dest="minaccuracy", type=float, default=MIN_ACCURACY
+                    , help="Fraction of expansions within the scale tolerance for a run to pass. (%(default)s)")
+
+parser.add_argument("-o", "--output", dest="output", default=None
+                    , help="Write the JSON report to this file instead of stdout.")
+
+opts = parser.parse_args()
+if opts.matcher == 'lsh' and not ENGINES[opts.features].binary:
+    parser.error("LSH matching requires binary descriptors, %s descriptors are floating point" % opts.features.upper())
+if opts.matcher == 'kdtree' and ENGINES[opts.features].binary:
+    parser.error("KD-tree matching requires floating point descriptors, %s descriptors are binary" % opts.features.upper())
+
+sizes = map(parseSize, opts.sizes.split(','))
+patchcounts = map(int, opts.patches.split(','))
+tiles = parseSize(opts.tiles) if opts.tiles else None
+
+runs = []
+for shape in sizes:
+    h, w = shape
+    pool = smatch.ResidualPool(shape, opts.workers) if opts.workers else None
+    for npatches in patchcounts:
+        scene = ExpandingScene(shape, npatches, seed=opts.seed, region=(w//4, h//4, w-w//4, h-h//4))
+        if tiles:
+            detector = TiledDetector(opts.features, (w//4, h//4, w-w//4, h-h//4), tiles, opts.threshold
+                                     , maxPerTile=opts.tilefeatures)
+        else:
+            detector = FeatureEngine(opts.features, opts.threshold)
+        matcher = DescriptorMatcher(opts.matcher, binary=detector.binary, radius=opts.matchradius)
+        result = runSequence(scene, opts.frames, detector, matcher, opts.scalesearch, opts.predictscale, pool)
+        runs.append(summarize(shape, npatches, opts.frames, *result, minaccuracy=opts.minaccuracy))
+        if tiles: detector.close()
+
+        r = runs[-1]
+        print >> sys.stderr, "%4dx%-4d %3d patches: %6.1f kps, %6.1f ms/frame, accuracy %s" \
+            % (h, w, npatches, r['keypoints'], sum(r['timing_ms'][s]['mean'] for s in STAGES)
+               , "%.3f" % r['accuracy'] if r['accuracy'] is not None else "n/a")
+    if pool: pool.close()
+
+report = dict(options=vars(opts), scale_tolerance=SCALE_TOLERANCE
+              , environment=dict(python=platform.python_version(), opencv=cv2.__version__
+                                 , numpy=np.__version__, machine=platform.machine())
+              , runs=runs, passed=all(r['passed'] for r in runs))
+
+if opts.output:
+    with open(opts.output, 'w') as f: json.dump(report, f, indent=2, sort_keys=True)
+else:
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print
+
+sys.exit(0 if report['passed'] else 1)
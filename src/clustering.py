@@ -0,0 +1,72 @@
+from collections import defaultdict
+
+import numpy as np
+
+from common import Cluster
+
+# grid cells compared with each cell, half of the 3x3 neighbourhood so that
+# every pair of cells is only compared once
+HALF_NEIGHBOURS = ((0,0), (1,-1), (1,0), (1,1), (0,1))
+
+
+def _find(parent,i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def _union(parent,i,j):
+    i, j = _find(parent,i), _find(parent,j)
+    if i < j: parent[j] = i
+    elif j < i: parent[i] = j
+
+
+def overlapLabels(keypoints,eps=0):
+    '''
+    Label every keypoint with the smallest index of the keypoints it
+    overlaps with, directly or through other keypoints. Keypoints are
+    binned into a grid of cells as wide as the largest overlap distance,
+    so only keypoints in neighbouring cells are compared.
+    '''
+    n = len(keypoints)
+    parent = np.arange(n)
+    if n < 2: return parent
+
+    x, y, r = keypoints['x'], keypoints['y'], keypoints['size']//2
+    cell = max(2*r.max()+eps, 1.)
+    cells = defaultdict(list)
+    for i,key in enumerate(zip((x//cell).astype(int).tolist(), (y//cell).astype(int).tolist())):
+        cells[key].append(i)
+    cells = dict((key,np.array(idx)) for key,idx in cells.iteritems())
+
+    for (i,j),a in cells.iteritems():
+        for di,dj in HALF_NEIGHBOURS:
+            b = cells.get((i+di,j+dj))
+            if b is None: continue
+            dist = np.sqrt((x[a][:,None]-x[b])**2 + (y[a][:,None]-y[b])**2)
+            hit = (r[a][:,None]+r[b]+eps) > dist
+            if not (di or dj): hit = np.triu(hit,1)
+            for p,q in zip(*np.nonzero(hit)): _union(parent,a[p],b[q])
+
+    # flatten the trees so every keypoint points at its root
+    while True:
+        grand = parent[parent]
+        if np.array_equal(grand,parent): return parent
+        parent = grand
+
+
+def clusterKeypoints(keypoints,shape,minsize=2,eps=0):
+    '''
+    Group the keypoints (any array with the KEYPOINT_DTYPE fields) of a
+    frame of the given shape into Clusters of at least minsize overlapping
+    keypoints, largest cluster first.
+    '''
+    if len(keypoints) < minsize: return []
+
+    labels = overlapLabels(keypoints,eps)
+    order = np.argsort(labels, kind='mergesort')
+    _, start, counts = np.unique(labels[order], return_index=True, return_counts=True)
+    clusters = [Cluster(keypoints[order[s:s+c]],shape) for s,c in zip(start,counts) if c >= minsize]
+    clusters.sort(key=lambda c: c.area, reverse=True)
+
+    return clusters
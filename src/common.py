@@ -1,60 +1,149 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 import numpy as np
 import cv2
-from operator import attrgetter
-
-
-class KeyPointHistory(object):
-    def __init__(self):
-        self.age = -1
-        self.lastFrameIdx = 0
-        self.detects = 0
-        self.scalehist = []
-        self.timehist = []
-        self.keypoint = None
-        self.descriptor = None
-        self.consecutive = 0
-
-    def update(self,kp,desc,t0,t1,scale):
-        if self.timehist and t0 == self.timehist[-1][-1]:
-            self.consecutive += 1
-        else:
-            self.consecutive = 1
-
-        self.age = -1
-        self.lastFrameIdx = 0
-        self.detects += 1
-        self.scalehist.append(scale)
-        self.timehist.append((t0,t1))
-        self.descriptor = desc.copy()
-        self.keypoint = copyKP(kp)
-
-    def downdate(self):
-        self.age += 1
-        self.lastFrameIdx -= 1
-        return self
 
-    def __repr__(self):
-        return repr(dict((attr,getattr(self,attr)) for attr in dir(self)
-                         if not attr.startswith('_') and not callable(getattr(self,attr))))
-    def __str__(self):
-        return str(dict((attr,getattr(self,attr)) for attr in dir(self)
-                         if not attr.startswith('_') and not callable(getattr(self,attr))))        
+STATS_WINDOW = 300 # passes kept for the rolling latency percentiles
+HISTORY_DEPTH = 8 # scale and time steps kept per keypoint track
+TTC_SCALE_NOISE = 0.025 # std of a scale estimate, about one step of the scale search
+TTC_RATE_NOISE = 0.5 # drift of a track's expansion rate in 1/s per sqrt(s)
+
+# keypoints are carried through the tracker as arrays of this type and only
+# turned into cv2.KeyPoints for drawing
+KEYPOINT_DTYPE = np.dtype([('x',np.float64), ('y',np.float64), ('size',np.float64)
+                           , ('response',np.float64), ('class_id',np.int64)])
+
+# matches between keypoint arrays, named after the cv2.DMatch attributes
+MATCH_DTYPE = np.dtype([('queryIdx',np.intp), ('trainIdx',np.intp), ('distance',np.float64)])
+
+
+class PatchStats(object):
+    '''
+    PatchStats
+
+    Integral images of a frame and of its square, giving the mean and
+    standard deviation of any rectangular patch in constant time.
+    '''
+    def __init__(self,img):
+        self.sum, self.sqsum = cv2.integral2(img,sdepth=cv2.CV_64F,sqdepth=cv2.CV_64F)
+
+    def meanStd(self,x0,y0,x1,y1):
+        '''
+        Mean and standard deviation of img[y0:y1,x0:x1]. Coordinates may be
+        arrays to look up many patches at once.
+        '''
+        S, SQ = self.sum, self.sqsum
+        n = (x1-x0)*(y1-y0)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            mean = (S[y1,x1] - S[y0,x1] - S[y1,x0] + S[y0,x0]) / n
+            var = (SQ[y1,x1] - SQ[y0,x1] - SQ[y1,x0] + SQ[y0,x0]) / n - mean**2
+        # flat patches can come out with a tiny variance from round off
+        return mean, np.sqrt(np.where(var > 1e-6, var, 0))
+
 
 class Cluster(object):
-    def __init__(self,keypoints,img):
-        self.mask = np.zeros_like(img)
-        for kp in keypoints:
-            cv2.circle(self.mask,inttuple(*kp.pt),int(kp.size//2),1,thickness=-1)
-        self.area = np.sum(self.mask)
-        self.pt = findCoM(self.mask)
-        self.p0, self.p1 = BlobBoundingBox(self.mask)
-        self.KPs = [copyKP(kp) for kp in keypoints]
-        self.dist = [diffKP_L2(self.KPs[i],self.KPs[j]) for i in range(len(self.KPs)-1) for j in range(i+1,len(self.KPs))]
+    '''
+    Cluster
+
+    A group of overlapping keypoints in a frame of the given shape. The
+    keypoints' circles are drawn into a mask only as large as their bounding
+    box, which sits at offset in the frame; the centre of mass pt and the
+    bounding box p0, p1 are in frame coordinates.
+    '''
+    def __init__(self,keypoints,shape):
+        cx, cy = keypoints['x'].astype(int), keypoints['y'].astype(int)
+        r = (keypoints['size']//2).astype(int)
+        x0, y0 = max((cx-r).min(),0), max((cy-r).min(),0)
+        x1, y1 = min((cx+r).max()+1,shape[1]), min((cy+r).max()+1,shape[0])
+        self.offset = x0, y0
+        self.mask = np.zeros((y1-y0,x1-x0),np.uint8)
+        for x,y,rad in zip(cx-x0,cy-y0,r):
+            cv2.circle(self.mask,(int(x),int(y)),int(rad),1,thickness=-1)
+        self.area = np.count_nonzero(self.mask)
+        x, y = findCoM(self.mask)
+        self.pt = x+x0, y+y0
+        (px0,py0), (px1,py1) = BlobBoundingBox(self.mask)
+        self.p0, self.p1 = (px0+x0,py0+y0), (px1+x0,py1+y0)
+        self.KPs = keypoints.copy()
+        i, j = np.triu_indices(len(self.KPs), 1)
+        self.dist = diffKP_L2(self.KPs[i],self.KPs[j])
 
     def __repr__(self):
         return str(map(repr,(self.pt,self.area,len(self.KPs))))
 
 
+class StageTimer(object):
+    '''
+    StageTimer
+
+    Accumulates the time spent in and the number of passes through named
+    stages of the frame loop. The latencies of the last window passes of
+    every stage are kept for percentiles, as are the last window values of
+    named per frame counts (keypoints, matches, ...). Stages may be timed
+    from several threads.
+    '''
+    def __init__(self,window=STATS_WINDOW):
+        self.window = window
+        self.total = OrderedDict()
+        self.count = OrderedDict()
+        self.recent = OrderedDict()
+        self.counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def time(self,stage):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time()-t0)
+
+    def add(self,stage,seconds):
+        with self._lock:
+            self.total[stage] = self.total.get(stage,0.) + seconds
+            self.count[stage] = self.count.get(stage,0) + 1
+            if stage not in self.recent: self.recent[stage] = deque(maxlen=self.window)
+            self.recent[stage].append(seconds)
+
+    def last(self,*stages):
+        '''
+        Total seconds of the latest pass through each of stages.
+        '''
+        with self._lock:
+            return sum(self.recent[stage][-1] for stage in stages if stage in self.recent)
+
+    def tally(self,name,n):
+        with self._lock:
+            if name not in self.counts: self.counts[name] = deque(maxlen=self.window)
+            self.counts[name].append(n)
+
+    def summary(self):
+        '''
+        Lifetime pass counts and the rolling p50/p95/p99/max latency in ms of
+        every stage, and the rolling mean of every count.
+        '''
+        with self._lock:
+            recent = [(stage, self.count[stage], np.array(lat)) for stage,lat in self.recent.iteritems()]
+            counts = [(name, np.mean(c)) for name,c in self.counts.iteritems()]
+        stages = OrderedDict()
+        for stage, count, lat in recent:
+            p50, p95, p99 = np.percentile(lat*1000, (50,95,99))
+            stages[stage] = OrderedDict((('count',count), ('p50',p50), ('p95',p95), ('p99',p99)
+                                         , ('max',lat.max()*1000)))
+        return OrderedDict((('stages',stages), ('counts',OrderedDict(counts))))
+
+    def report(self):
+        summary = self.summary()
+        lines = ["%-10s: %6d passes, %8.2f ms/pass, %8.2f s total, p50/p95/p99/max %.2f/%.2f/%.2f/%.2f ms"
+                 % ((stage, self.count[stage], self.total[stage]/self.count[stage]*1000, self.total[stage])
+                    + tuple(s[k] for k in ('p50','p95','p99','max')))
+                 for stage,s in summary['stages'].iteritems()]
+        lines += ["%-10s: %8.1f per frame" % kv for kv in summary['counts'].iteritems()]
+        return lines
+
+
 def BlobBoundingBox(blob):
     diff = blob.any(axis=0)
     ones = np.flatnonzero(diff)
@@ -82,11 +171,12 @@ trunc_coords = lambda shape,xy: [x if x >= 0 and x <= dimsz else (0 if x < 0 els
 
 bboverlap = lambda cl1,cl2: (cl1.p0[0] <= cl2.p1[0] and cl1.p1[0] >= cl2.p0[0]) and (cl1.p0[1] <= cl2.p1[1] and cl1.p1[1] >= cl2.p0[1])
 
-overlap = lambda kp1,kp2,eps=0: (kp1.size//2+kp2.size//2+eps) > diffKP_L2(kp1,kp2)
+# keypoint helpers take KEYPOINT_DTYPE records or arrays of them
+overlap = lambda kp1,kp2,eps=0: (kp1['size']//2+kp2['size']//2+eps) > diffKP_L2(kp1,kp2)
 
-diffKP_L2 = lambda kp0,kp1: np.sqrt((kp0.pt[0]-kp1.pt[0])**2 + (kp0.pt[1]-kp1.pt[1])**2)
+diffKP_L2 = lambda kp0,kp1: np.sqrt((kp0['x']-kp1['x'])**2 + (kp0['y']-kp1['y'])**2)
 
-diffKP = lambda kp0,kp1: (kp0.pt[0]-kp1.pt[0], kp0.pt[1]-kp1.pt[1])
+diffKP = lambda kp0,kp1: (kp0['x']-kp1['x'], kp0['y']-kp1['y'])
 
 difftuple_L2 = lambda p0,p1: np.sqrt((p0[0]-p1[0])**2 + (p0[1]-p1[1])**2)
 
@@ -96,9 +186,49 @@ inttuple = lambda *x: tuple(map(int,x))
 
 roundtuple = lambda *x: tuple(map(int,map(round,x)))
 
-avgKP = lambda keypoints: map(lambda x: sum(x)/len(keypoints),zip(*map(attrgetter('pt'),keypoints)))
-
-toKeyPoint_cv = lambda kp: cv2.KeyPoint(kp.pt[0],kp.pt[1],kp.size,_angle=kp.angle,_response=kp.response,_octave=kp.octave,_class_id=kp.class_id)
+avgKP = lambda keypoints: (np.mean(keypoints['x']), np.mean(keypoints['y']))
+
+def filterExpansionRate(rate,var,scale,dt):
+    '''
+    One Kalman filter update of the expansion rate log(scale)/dt of tracks,
+    in 1/s, and its variance from a new scale measured over dt seconds.
+    Tracks without an estimate have an infinite variance and take the
+    measurement; tracks with dt <= 0 are left as they are.
+    '''
+    rate, var, scale, dt = np.broadcast_arrays(*map(np.asarray,(rate,var,scale,dt)))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        z = np.log(scale)/dt
+        R = (TTC_SCALE_NOISE/dt)**2
+        P = var + TTC_RATE_NOISE**2*dt
+        K = np.where(np.isfinite(P), P/(P+R), 1.)
+        newrate = np.where(np.isfinite(P), rate + K*(z-rate), z)
+        newvar = np.where(np.isfinite(P), (1-K)*P, R)
+    valid = dt > 0
+    return np.where(valid,newrate,rate), np.where(valid,newvar,var)
+
+def ttcFromRate(rate,var):
+    '''
+    Time to contact in seconds of tracks expanding at rate, and its variance,
+    infinite for tracks that are not expanding.
+    '''
+    rate, var = np.asarray(rate,np.float64), np.asarray(var,np.float64)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        ttc = np.where(rate > 0, 1./rate, np.inf)
+        ttcvar = np.where(rate > 0, var/rate**4, np.inf)
+    return ttc, ttcvar
+
+def matchArray(queryIdx,trainIdx,distance=0.):
+    matches = np.empty(len(queryIdx), MATCH_DTYPE)
+    matches['queryIdx'], matches['trainIdx'], matches['distance'] = queryIdx, trainIdx, distance
+    return matches
+
+def toKeypointArray(keypoints):
+    if isinstance(keypoints, np.ndarray): return keypoints
+    return np.array([(kp.pt[0],kp.pt[1],kp.size,kp.response,kp.class_id) for kp in keypoints], KEYPOINT_DTYPE)
+
+def toCvKeyPoints(keypoints):
+    return [cv2.KeyPoint(float(kp['x']),float(kp['y']),float(kp['size']),-1,float(kp['response']),0,int(kp['class_id']))
+            for kp in keypoints]
 
 def reprObj(obj):
     return "\n".join(["%s = %s" % (attr, getattr(obj, attr)) for attr in dir(obj) if not attr.startswith('_') and not callable(getattr(src,attr))])
@@ -107,12 +237,9 @@ def cvtIdx(pt,shape):
     return int(pt[1]*shape[1] + pt[0]) if hasattr(pt, '__len__') else map(int, (pt%shape[1], pt//shape[1]))
 
 
+def stampValue(t):
+    # ROS stamps in seconds, video file times as they are (ms)
+    return t.to_sec() if hasattr(t,'to_sec') else float(t)
+
 def drawInto(src, dst, tl=(0,0)):
     dst[tl[1]:tl[1]+src.shape[0], tl[0]:tl[0]+src.shape[1]] = src
-
-def copyKP(src,dst=None):
-    if dst is None: dst = cv2.KeyPoint()
-    for attr in dir(src):
-        if not attr.startswith('_') and not callable(getattr(src,attr)):
-            setattr(dst,attr,getattr(src,attr))
-    return dst
@@ -1,4 +1,4 @@
-from flownav.msg import ttc
+from flownav.msg import ttc, stats, latency
 import rospy
 
 class DataLogger(object):
@@ -8,3 +8,28 @@ class DataLogger(object):
     def write(self,msg=None,**kwargs):
         if msg is not None: return self.publisher.publish(msg)
         self.publisher.publish(**kwargs)
+
+class StatsLogger(object):
+    '''
+    StatsLogger
+
+    Publishes the summary of a StageTimer on the stats topic at most once
+    every period seconds.
+    '''
+    def __init__(self,topic="/flownav/stats",period=1.):
+        self.publisher = rospy.Publisher(topic, stats, queue_size=1)
+        self.period = period
+        self._last = 0
+
+    def write(self,frame_id,timer,force=False):
+        now = rospy.get_time()
+        if not force and (now-self._last) < self.period: return
+        self._last = now
+
+        summary = timer.summary()
+        counts = summary['counts']
+        self.publisher.publish(frame_id=frame_id
+                               , stages=[latency(stage=k,**s) for k,s in summary['stages'].iteritems()]
+                               , keypoints=counts.get('keypoints',0)
+                               , matches=counts.get('matches',0)
+                               , expanding=counts.get('expanding',0))
@@ -0,0 +1,214 @@
+from collections import OrderedDict, namedtuple
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import cv2
+import numpy as np
+
+from common import KEYPOINT_DTYPE, toKeypointArray
+
+ORB_FEATURES = 2000 # keep ORB's cap out of the way of the threshold
+# pixels of context around each tile for the detectors' scale space: ORB
+# drops keypoints within 31 pixels of the border of every pyramid level
+# (up to 111 full scale pixels at its coarsest level) and BRISK and AKAZE
+# need the support of their coarsest octaves. With 32 pixels a 2x2 grid
+# found only 94% of AKAZE's full frame keypoints and 82% of ORB's.
+TILE_MARGIN = 96
+
+# the descriptor type and matching thresholds of a feature engine, its
+# default threshold and the range an adaptive threshold is kept in. Binary
+# descriptor distances are Hamming distances in bits. ORB's maxdist of 80
+# (of 256) bits keeps every match that passes the ratio test on the
+# benchmark scenes and zoom.avi; 64 dropped a sixth of them on the former.
+EngineParams = namedtuple('EngineParams', 'binary threshold thresholds integer ratio maxdist')
+
+ENGINES = OrderedDict((
+    ('surf', EngineParams(binary=False, threshold=2000., thresholds=(500.,10000.), integer=False
+                          , ratio=0.8, maxdist=0.25)),
+    ('orb', EngineParams(binary=True, threshold=20., thresholds=(5.,80.), integer=True
+                         , ratio=0.8, maxdist=80)),
+    ('brisk', EngineParams(binary=True, threshold=30., thresholds=(10.,120.), integer=True
+                           , ratio=0.8, maxdist=120)),
+    ('akaze', EngineParams(binary=True, threshold=0.001, thresholds=(1e-4,1e-2), integer=False
+                           , ratio=0.8, maxdist=120)),
+))
+
+
+def _surf(threshold, nfeatures):
+    if hasattr(cv2, 'SURF'):
+        return cv2.SURF(hessianThreshold=threshold, extended=True, upright=True)
+    return cv2.xfeatures2d.SURF_create(hessianThreshold=threshold, extended=True, upright=True)
+
+def _orb(threshold, nfeatures):
+    if hasattr(cv2, 'ORB_create'):
+        return cv2.ORB_create(nfeatures=nfeatures, fastThreshold=int(threshold))
+    return cv2.ORB(nfeatures=nfeatures) # OpenCV 2.4's ORB has a fixed FAST threshold
+
+def _brisk(threshold, nfeatures):
+    if hasattr(cv2, 'BRISK_create'):
+        return cv2.BRISK_create(thresh=int(threshold))
+    return cv2.BRISK(thresh=int(threshold))
+
+def _akaze(threshold, nfeatures):
+    return cv2.AKAZE_create(threshold=threshold)
+
+_FACTORIES = dict(surf=_surf, orb=_orb, brisk=_brisk, akaze=_akaze)
+
+def _available(name):
+    try:
+        _FACTORIES[name](ENGINES[name].threshold, ORB_FEATURES)
+    except (AttributeError, cv2.error):
+        return False
+    return True
+
+# only offer the engines the installed OpenCV provides: SURF needs the
+# nonfree contrib modules and AKAZE OpenCV 3
+for _name in list(ENGINES):
+    if not _available(_name): del ENGINES[_name]
+DEFAULT_ENGINE = 'surf' if 'surf' in ENGINES else next(iter(ENGINES))
+
+
+class FeatureEngine(object):
+    '''
+    FeatureEngine
+
+    A keypoint detector and descriptor extractor chosen by name from
+    ENGINES, with the descriptor type and ratio test and distance thresholds
+    to match its descriptors by. All engines give keypoints a size, which
+    expansion estimation depends on. ORB's sizes are quantized to its
+    pyramid levels (31 pixels times 1.2 per level), so the tracker's
+    prefilter, which needs the train keypoint to be larger than the query
+    keypoint, only passes matches that moved up a level: about 8% of ORB's
+    matches on zoom.avi and none on the benchmark scenes.
+
+    threshold is the engine's detection threshold: the Hessian threshold for
+    SURF, the FAST threshold for ORB, the AGAST threshold for BRISK and the
+    detector response threshold for AKAZE. It may be changed between frames.
+    nfeatures caps the keypoints of the engines that have a cap (ORB); it
+    may be changed too.
+    '''
+    def __init__(self, name='surf', threshold=None, nfeatures=ORB_FEATURES):
+        if name not in ENGINES:
+            raise ValueError("Unknown feature engine %r" % name)
+        self.name = name
+        self.params = ENGINES[name]
+        self.binary = self.params.binary
+        self.ratio = self.params.ratio
+        self.maxdist = self.params.maxdist
+        self._nfeatures = nfeatures
+        self.detector = None
+        self._threshold = None
+        self.threshold = self.params.threshold if threshold is None else threshold
+
+    @property
+    def threshold(self): return self._threshold
+
+    @threshold.setter
+    def threshold(self, value):
+        value = float(round(value) if self.params.integer else value)
+        # detectors are recreated since not all of them can be changed in place
+        if value != self._threshold:
+            self.detector = _FACTORIES[self.name](value, self.nfeatures)
+            self._threshold = value
+
+    @property
+    def nfeatures(self): return self._nfeatures
+
+    @nfeatures.setter
+    def nfeatures(self, value):
+        if value != self._nfeatures:
+            self._nfeatures = value
+            self.detector = _FACTORIES[self.name](self._threshold, value)
+
+    def detectAndCompute(self, img, mask=None):
+        return self.detector.detectAndCompute(img, mask)
+
+
+class TiledDetector(object):
+    '''
+    TiledDetector
+
+    Detects keypoints in the rectangle rect=(x0,y0,x1,y1) of a frame split
+    into a grid=(rows,cols) of tiles, one FeatureEngine per tile run in a
+    pool of threads. Each tile is a view into the frame extended by margin
+    pixels of context on every side, and only keypoints that fall in the
+    tile proper are kept, so keypoints in the overlaps are not found twice.
+    If maxPerTile is set, each tile keeps its maxPerTile strongest keypoints
+    to spread keypoints evenly over the frame.
+
+    The keypoints are close to but not the same as full frame detection's.
+    On 480x640 synthetic frames split into 2x2 tiles, the tiles find 99.5%
+    of AKAZE's, 95% of ORB's and 92% of BRISK's full frame keypoints (within
+    2 pixels and 20% in size). The pyramids of the tiles are sampled from
+    other origins, which moves some keypoints, most of all BRISK's, whatever
+    the margin. ORB's cap is split over the tiles by the area each searches,
+    so a textured tile can no longer take keypoints from a bare one, and
+    the tiles keep about a fifth more ORB keypoints than one full frame
+    detector would.
+
+    detectAndCompute returns a KEYPOINT_DTYPE array and the descriptors; the
+    mask is ignored since only rect is searched. Like a FeatureEngine, it
+    has the descriptor type, matching thresholds and a settable threshold.
+    '''
+    def __init__(self, name, rect, grid=(2,2), threshold=None, margin=TILE_MARGIN, maxPerTile=None, threads=None):
+        rows, cols = grid
+        x0, y0, x1, y1 = rect
+        xs = np.linspace(x0, x1, cols+1).round().astype(int)
+        ys = np.linspace(y0, y1, rows+1).round().astype(int)
+        self.tiles = [(xs[j], ys[i], xs[j+1], ys[i+1]) for i in range(rows) for j in range(cols)]
+        self.engines = [FeatureEngine(name, threshold) for t in self.tiles]
+        self.area = float((x1-x0)*(y1-y0))
+        self.margin = margin
+        self._shape = None
+        self.maxPerTile = maxPerTile
+        self.binary = self.engines[0].binary
+        self.ratio = self.engines[0].ratio
+        self.maxdist = self.engines[0].maxdist
+        self.pool = ThreadPool(threads or min(len(self.tiles), cpu_count()))
+
+    @property
+    def threshold(self): return self.engines[0].threshold
+
+    @threshold.setter
+    def threshold(self, value):
+        for engine in self.engines: engine.threshold = value
+
+    def _window(self, tile, shape):
+        # the tile extended by the margin, clipped at the frame border
+        x0, y0, x1, y1 = tile
+        h, w = shape[:2]
+        return max(x0-self.margin, 0), max(y0-self.margin, 0), min(x1+self.margin, w), min(y1+self.margin, h)
+
+    def _shareCap(self, shape):
+        # the tiles share the engine's cap by the area they search, margin
+        # included, as keypoints found in the margin count against it too
+        for engine, tile in zip(self.engines, self.tiles):
+            ex0, ey0, ex1, ey1 = self._window(tile, shape)
+            engine.nfeatures = int(np.ceil(ORB_FEATURES*(ex1-ex0)*(ey1-ey0)/self.area))
+        self._shape = shape[:2]
+
+    def _detectTile(self, args):
+        engine, (x0,y0,x1,y1), img = args
+        ex0, ey0, ex1, ey1 = self._window((x0,y0,x1,y1), img.shape)
+        keypoints, desc = engine.detectAndCompute(img[ey0:ey1, ex0:ex1])
+        keypoints = toKeypointArray(keypoints)
+        keypoints['x'] += ex0
+        keypoints['y'] += ey0
+
+        inside = np.flatnonzero((keypoints['x'] >= x0) & (keypoints['x'] < x1)
+                                & (keypoints['y'] >= y0) & (keypoints['y'] < y1))
+        if self.maxPerTile and len(inside) > self.maxPerTile:
+            inside = inside[np.argsort(-keypoints['response'][inside], kind='mergesort')[:self.maxPerTile]]
+        return keypoints[inside], (desc[inside] if desc is not None else None)
+
+    def detectAndCompute(self, img, mask=None):
+        if img.shape[:2] != self._shape: self._shareCap(img.shape)
+        found = self.pool.map(self._detectTile, [(e, t, img) for e,t in zip(self.engines, self.tiles)])
+        found = [(kp, desc) for kp,desc in found if len(kp)]
+        if not found: return np.empty(0, KEYPOINT_DTYPE), None
+        keypoints, descriptors = zip(*found)
+        return np.concatenate(keypoints), np.concatenate(descriptors)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
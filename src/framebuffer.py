@@ -1,16 +1,33 @@
 import sys
+import threading
+import time
+from collections import deque
 from cv_bridge import CvBridge, CvBridgeError
-from sensor_msgs.msg import Image
+from sensor_msgs.msg import Image, CompressedImage
 from std_msgs.msg import Empty
 from ardrone_autonomy.msg import Navdata
 import rospy
 import cv2
 import numpy as np
+from common import PatchStats
+from pipeline import POLL_PERIOD
 
 VERBOSE = 0
+DECODE_QUEUE_SIZE = 2 # compressed images waiting to be decoded
+
+MONO_ENCODINGS = ('mono8','8UC1')
+GRAY_CONVERSIONS = {'bgr8': cv2.COLOR_BGR2GRAY, 'rgb8': cv2.COLOR_RGB2GRAY
+                    , 'bgra8': cv2.COLOR_BGRA2GRAY, 'rgba8': cv2.COLOR_RGBA2GRAY}
 
 
 class VideoBuffer(object):
+    '''
+    VideoBuffer
+
+    Reads frames from a video file or capture device into a ring of
+    preallocated grayscale frames. grab returns views into the ring, which
+    stay valid until the ring wraps around onto them.
+    '''
     def __init__(self,vidfile,start=None,stop=None,loop=False,historysize=1):
         self.cap = cv2.VideoCapture(vidfile)
         self.name = str(vidfile)
@@ -20,7 +37,12 @@ class VideoBuffer(object):
         self.loop = loop
         self._size = historysize
         self._frameNum = 0
-        self._buffer = []
+        self._frames = None
+        self._times = np.full(self._size, -1.)
+        self._filled = np.zeros(self._size, np.bool_)
+        self._stats = [None]*self._size
+        self._head = -1
+        self._bgr = None
 
         if not self.live:
             if self.start is None:
@@ -38,34 +60,57 @@ class VideoBuffer(object):
             self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.start)
             self._frameNum = self.start
             self.looped = self.cap.get(cv2.CAP_PROP_POS_FRAMES) == self.stop
-        self._buffer = [np.array([])]*self._size
+        self._filled[:] = False
+        self._stats = [None]*self._size
         self.shiftBuffer(self._size)
 
+    def _slot(self,frameIdx):
+        # ring slot of the frame frameIdx <= 0 frames back from the newest
+        if frameIdx > 0 or -frameIdx >= self._size: return None
+        slot = (self._head+frameIdx) % self._size
+        return slot if self._filled[slot] else None
+
     def shiftBuffer(self,nshifts=1):
         for i in range(nshifts):
             if not self.live and self.cap.get(cv2.CAP_PROP_POS_FRAMES) == self.stop:
                 if not self.loop: return False
                 self._reset()
 
-            valid, img = self.cap.read()
+            # decode into the reused color frame and convert straight into
+            # the next slot of the ring
+            valid, self._bgr = self.cap.read(self._bgr)
             if not valid: return False
 
-            img = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
-            time = -1 if self.live else self.cap.get(cv2.CAP_PROP_POS_MSEC)
-
-            self._buffer[:-1] = self._buffer[1:]
-            self._buffer[-1] = (img,time)
+            slot = (self._head+1) % self._size
+            if self._frames is None:
+                self._frames = np.empty((self._size,)+self._bgr.shape[:2], np.uint8)
+            cv2.cvtColor(self._bgr,cv2.COLOR_BGR2GRAY,dst=self._frames[slot])
+            self._times[slot] = -1 if self.live else self.cap.get(cv2.CAP_PROP_POS_MSEC)
+            self._filled[slot] = True
+            self._stats[slot] = None
+            self._head = slot
         return True
 
     def grab(self,frameIdx=1):
         if frameIdx > 0:
             if not self.shiftBuffer(): return np.array([]), -1
-            frameIdx = -1
+            frameIdx = 0
             self._frameNum += 1
-        else:
-            frameIdx -= 1
-            
-        return self._buffer[frameIdx]
+
+        slot = self._slot(frameIdx)
+        if slot is None: return np.array([]), -1
+        return self._frames[slot], self._times[slot]
+
+    def grabStats(self,frameIdx=0):
+        '''
+        Patch statistics of a buffered frame, indexed as in grab(frameIdx)
+        for frameIdx <= 0. They are computed on first use and shared until
+        the frame leaves the buffer.
+        '''
+        slot = self._slot(frameIdx)
+        if self._stats[slot] is None:
+            self._stats[slot] = PatchStats(self._frames[slot])
+        return self._stats[slot]
 
     def seek(self,nframes):
         if self.live: return
@@ -77,7 +122,57 @@ class VideoBuffer(object):
 
     def close(self):
         self.cap.release()
-        del self._buffer
+        del self._frames
+
+
+class FrameHistory(object):
+    '''
+    FrameHistory
+
+    A ring of copies of the frames pushed into it, indexed as the buffers'
+    grab(frameIdx) for frameIdx <= 0. Used when frames are grabbed on one
+    thread and processed on another, so that the history seen by the
+    processing thread does not move while it works.
+    '''
+    def __init__(self,historysize=1):
+        self._size = historysize
+        self._frames = None
+        self._times = np.full(self._size, -1, object)
+        self._filled = np.zeros(self._size, np.bool_)
+        self._stats = [None]*self._size
+        self._head = -1
+
+    def _slot(self,frameIdx):
+        if frameIdx > 0 or -frameIdx >= self._size: return None
+        slot = (self._head+frameIdx) % self._size
+        return slot if self._filled[slot] else None
+
+    def clear(self):
+        self._filled[:] = False
+        self._stats = [None]*self._size
+
+    def push(self,img,t):
+        if self._frames is None or self._frames.shape[1:] != img.shape:
+            self._frames = np.empty((self._size,)+img.shape, np.uint8)
+            self.clear()
+        slot = (self._head+1) % self._size
+        np.copyto(self._frames[slot], img)
+        self._times[slot] = t
+        self._filled[slot] = True
+        self._stats[slot] = None
+        self._head = slot
+        return self._frames[slot]
+
+    def grab(self,frameIdx=0):
+        slot = self._slot(frameIdx)
+        if slot is None: return np.array([]), -1
+        return self._frames[slot], self._times[slot]
+
+    def grabStats(self,frameIdx=0):
+        slot = self._slot(frameIdx)
+        if self._stats[slot] is None:
+            self._stats[slot] = PatchStats(self._frames[slot])
+        return self._stats[slot]
 
 
 class ROSCamBuffer(object):
@@ -85,51 +180,166 @@ class ROSCamBuffer(object):
     ROSCamBuffer
 
     Creates a subcription node to the image publisher and converts the image
-    into opencv image type.
+    into opencv image type. Frames are kept in a ring of preallocated
+    grayscale frames and grab returns views into the ring. Raw images are
+    converted to grayscale straight into the ring, without any conversion
+    for mono8 sources. With compressed set, the topic is a
+    sensor_msgs/CompressedImage topic whose messages are decoded to
+    grayscale on a worker thread, dropping the oldest pending messages if
+    decoding falls behind.
+
+    grab blocks until the subscriber callback signals a new frame. The time
+    spent waiting and the latency from callback to consumption of the last
+    grabbed frame are kept in waitTime and latency, and their running sums
+    in totalWaitTime and totalLatency.
     '''
-    def __init__(self, topic, historysize=0,buffersize=30):
+    def __init__(self, topic, historysize=0,buffersize=30,compressed=False):
         self.name=topic
         self.bridge = CvBridge()
-        self.image_sub = rospy.Subscriber(topic, Image, self.shiftBuffer)
         self._size = historysize+buffersize
         self._histsize = historysize
-        self._buffer = [(np.array([]),-1)]*self._size
+        self._frames = None
+        self._stamps = np.full(self._size, -1, object)
+        self._filled = np.zeros(self._size, np.bool_)
+        self._stats = [None]*self._size
+        self._recvtimes = np.zeros(self._size)
+        self._head = -1
         self._currIdx = 0
+        self._cond = threading.Condition()
         self.frameNum = 0
+        self.waitTime = self.totalWaitTime = 0.
+        self.latency = self.totalLatency = 0.
 
-    def shiftBuffer(self,data):
-        try:
-            img = self.bridge.imgmsg_to_cv2(data,'bgr8')
-            img = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
-        except rospy.ROSException:
-            raise
-        except KeyboardInterrupt:
-            raise
+        self._closed = False
+        if compressed:
+            self._pending = deque(maxlen=DECODE_QUEUE_SIZE)
+            self._pendingCond = threading.Condition()
+            self._decoder = threading.Thread(target=self._decodeLoop, name="ROSCamBuffer decoder")
+            self._decoder.daemon = True
+            self._decoder.start()
+            self.image_sub = rospy.Subscriber(topic, CompressedImage, self._enqueue)
+        else:
+            self.image_sub = rospy.Subscriber(topic, Image, self.shiftBuffer)
+        rospy.on_shutdown(self._wakeup)
+
+    def _slot(self,idx):
+        # ring slot of the frame at index idx of the equivalent list buffer,
+        # where -1 is the newest frame
+        return (self._head+1+idx) % self._size
+
+    def _nextSlot(self,shape):
+        # (re)allocate the ring for the incoming frame size
+        if self._frames is None or self._frames.shape[1:] != shape:
+            self._frames = np.empty((self._size,)+shape, np.uint8)
+            self._filled[:] = False
+            self._stats = [None]*self._size
+        return (self._head+1) % self._size
+
+    def _commit(self,slot,stamp,recvtime):
+        self._stamps[slot] = stamp
+        self._recvtimes[slot] = recvtime
+        self._filled[slot] = True
+        self._stats[slot] = None
+        self._head = slot
 
         if (self._currIdx-self._histsize) <= -self._size:
             if VERBOSE: print "ROSCamBuffer WARNING: Buffer overflow\r"
         else:
             self._currIdx -= 1
+        self._cond.notify()
+
+    def shiftBuffer(self,data):
+        recvtime = time.time()
+        with self._cond:
+            slot = self._nextSlot((data.height,data.width))
+            dst = self._frames[slot]
+            if data.encoding in MONO_ENCODINGS:
+                np.copyto(dst, self.bridge.imgmsg_to_cv2(data))
+            elif data.encoding in GRAY_CONVERSIONS:
+                cv2.cvtColor(self.bridge.imgmsg_to_cv2(data),GRAY_CONVERSIONS[data.encoding],dst=dst)
+            else:
+                np.copyto(dst, self.bridge.imgmsg_to_cv2(data,'mono8'))
+            self._commit(slot, data.header.stamp, recvtime)
 
-        self._buffer[:-1] = self._buffer[1:]
-        self._buffer[-1] = (img, data.header.stamp)
+    def _enqueue(self,data):
+        with self._pendingCond:
+            self._pending.append((data, time.time()))
+            self._pendingCond.notify()
 
-    def grab(self,frameIdx=1):
+    def _decodeLoop(self):
+        while True:
+            with self._pendingCond:
+                while not self._pending and not self._closed: self._pendingCond.wait()
+                if self._closed: return
+                data, recvtime = self._pending.popleft()
+
+            img = cv2.imdecode(np.frombuffer(data.data,np.uint8), cv2.IMREAD_GRAYSCALE)
+            if img is None:
+                if VERBOSE: print "ROSCamBuffer WARNING: Could not decode compressed image\r"
+                continue
+
+            with self._cond:
+                slot = self._nextSlot(img.shape)
+                np.copyto(self._frames[slot], img)
+                self._commit(slot, data.header.stamp, recvtime)
+
+    def _wakeup(self):
+        with self._cond: self._cond.notify_all()
+
+    def _ready(self):
+        return self._currIdx <= -self._histsize and self._filled[self._slot(self._currIdx)]
+
+    def grab(self,frameIdx=1,timeout=None):
+        '''
+        Grab the next frame if frameIdx > 0, blocking for at most timeout
+        seconds (forever if None) until one arrives, otherwise grab the frame
+        frameIdx frames back. An empty image is returned if nothing arrived.
+        '''
         if frameIdx > 0:
-            try: # spin until the buffer has something in it
-                while self._currIdx > -self._histsize or self._buffer[self._currIdx][0].size == 0: None
-            except KeyboardInterrupt:
-                raise
-            img, time = self._buffer[self._currIdx]
-            self._currIdx += 1
-            self.frameNum += 1
-        elif (self._currIdx-frameIdx) >= -self._size:
-            img, time = self._buffer[self._currIdx-frameIdx]
+            t0 = time.time()
+            with self._cond:
+                # wait for the subscriber to fill the buffer, in slices since
+                # an untimed wait can not be interrupted on Python 2
+                while not self._ready() and not rospy.is_shutdown():
+                    remaining = POLL_PERIOD if timeout is None else timeout-(time.time()-t0)
+                    if remaining <= 0: break
+                    self._cond.wait(min(remaining, POLL_PERIOD))
+                t1 = time.time()
+                self.waitTime = t1-t0
+                self.totalWaitTime += self.waitTime
+                if not self._ready(): return np.array([]), -1
+
+                slot = self._slot(self._currIdx)
+                img, stamp = self._frames[slot], self._stamps[slot]
+                self.latency = t1-self._recvtimes[slot]
+                self.totalLatency += self.latency
+                self._currIdx += 1
+                self.frameNum += 1
+            return img, stamp
+        elif (self._currIdx-frameIdx) >= -self._size and self._filled[self._slot(self._currIdx-frameIdx)]:
+            slot = self._slot(self._currIdx-frameIdx)
+            img, stamp = self._frames[slot], self._stamps[slot]
         else:
-            img, time = (np.array([]),-1)
+            img, stamp = (np.array([]),-1)
             
-        return img, time
+        return img, stamp
+
+    def grabStats(self,frameIdx=0):
+        '''
+        Patch statistics of a buffered frame, indexed as in grab(frameIdx)
+        for frameIdx <= 0. They are computed on first use and shared until
+        the frame leaves the buffer.
+        '''
+        slot = self._slot(self._currIdx-frameIdx)
+        stats = self._stats[slot]
+        if stats is None:
+            stats = self._stats[slot] = PatchStats(self._frames[slot])
+        return stats
 
     def close(self):
         self.image_sub.unregister()
-        del self._buffer
+        if hasattr(self,'_pending'):
+            with self._pendingCond:
+                self._closed = True
+                self._pendingCond.notify()
+        del self._frames
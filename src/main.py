@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 import rospy
-from datalogger import DataLogger
+from datalogger import DataLogger, StatsLogger
 from std_srvs.srv import Empty
 from genpy.rostime import Duration
 
@@ -9,55 +9,213 @@ from flownav.msg import keypoint as kpMsg
 
 import cv2
 import numpy as np
-import scipy.stats as stats
 
 from common import *
-from framebuffer import ROSCamBuffer,VideoBuffer
+from framebuffer import ROSCamBuffer,VideoBuffer,FrameHistory
 import framebuffer as fbuf
 import scale_matching as smatch
+import tracking
+from tracking import ExpansionTracker, LAST_DAY
+from matching import DescriptorMatcher, MATCHERS
+from pipeline import DropOldestQueue, Stage, POLL_PERIOD
+from threshold import ThresholdController, TARGET_N_KP
+from features import FeatureEngine, TiledDetector, ENGINES, DEFAULT_ENGINE
+from clustering import clusterKeypoints
 
 import operator as op
 from dronecontroller.keyboard import KeyboardController,CharMap,KeyMapping
-from collections import OrderedDict
+from collections import namedtuple
 
 import time,sys
+import csv
+import json
 
 
-TARGET_N_KP = 50
-MIN_THRESH = 2000
-MAX_THRESH = 2500
-LAST_DAY = 10
-
 VERBOSE = 1
 
 gmain_win = "flownav"
 gtemplate_win = "Template matching"
 
+# a grabbed frame with its detected features, and a tracked frame as passed
+# between the stages of the pipeline
+DetectedFrame = namedtuple('DetectedFrame', 'img t frameNum framePos looped keypoints descriptors')
+TrackedFrame = namedtuple('TrackedFrame', 'img t frameNum framePos pairs expansions')
 
-def ClusterKeypoints(keypoints,kphist,img):
-    if len(keypoints) < 2: return []
 
-    cluster = []
-    unclusteredKPs = sorted(keypoints,key=op.attrgetter('pt'))
-    while unclusteredKPs:
-        clust = [unclusteredKPs.pop(0)]
-        kp = clust[0]
-        i = 0
-        while i < len(unclusteredKPs):
-            if overlap(kp,unclusteredKPs[i]):
-                clust.append(unclusteredKPs.pop(i))
-            else:
-                i += 1
-        if (len(clust) >= 2): cluster.append(Cluster(clust,img))
-
-    return cluster
-
-
-def uniqid_gen():
-    uid = 2 # starts at 2 since default class_id for keypoints can be +/-1
-    while(1):
-        yield uid
-        uid += 1
+def framePosition():
+    return frmbuf.cap.get(cv2.CAP_PROP_POS_FRAMES) if opts.video and not frmbuf.live else None
+
+
+def trackFrame(t_curr, frameNum, trainKP, tdesc, dispim=None):
+    '''
+    Match the keypoints detected in the tracker's current frame to the last
+    frame's, estimate their expansion, update the history of expanding
+    keypoints and publish them. If dispim is given the matches are drawn onto
+    it and template matches are shown if enabled. If trainKP is None the
+    last frame's keypoints are tracked into the current frame by optical
+    flow instead.
+    '''
+    t_last = tracker.t_last
+    detected = trainKP is not None
+    t0 = time.time()
+    matches = tracker.match(trainKP, tdesc)
+    if detected:
+        timer.add('match', tracker.matcher.matchTime)
+        timer.add('filter', time.time()-t0-tracker.matcher.matchTime)
+    else:
+        timer.add('flow', time.time()-t0)
+        trainKP = tracker.trainKP
+    timer.tally('keypoints', len(trainKP))
+    pairs = (tracker.queryKP[matches['queryIdx']], trainKP[matches['trainIdx']])
+    timer.tally('matches', len(matches))
+    if dispim is not None:
+        with timer.time('draw'): drawMatches(dispim, pairs)
+
+    # Find an estimate of the scale change for keypoints that are expanding
+    # Then update the history of expanding keypoints
+    with timer.time('expansion'):
+        matches, kpscales = tracker.estimateExpansion(matches)
+
+    if opts.showmatches and dispim is not None:
+        lastkey = smatch.drawTemplateMatches(tracker.frmbuf, matches, tracker.queryKP, trainKP
+                                             , tracker.kpHist, kpscales, dispim=dispim)
+    else:
+        lastkey = None
+
+    with timer.time('history'):
+        expansions = tracker.update(matches, kpscales, t_curr)
+    timer.tally('expanding', len(expansions))
+
+    # adapt the detection threshold for the frames to come
+    if thresholder and detected:
+        thresholder.update(len(trainKP), timer.last('detect','match','filter','expansion','history'))
+        timer.tally('threshold', thresholder.threshold)
+
+    if opts.publish:
+        top = expansions[np.lexsort((-expansions['detects'],-expansions['scale']))[:10]]
+        keypoints = [kpMsg(x=e['x'], y=e['y']
+                           , scale=e['scale'], class_id=e['class_id']
+                           , detects=e['detects']
+                           , trainSize=e['size']
+                           , querySize=e['querySize']
+                           , ttc=e['ttc'], ttc_var=e['ttc_var']) for e in top]
+        with timer.time('publish'):
+            datalog.write(frame_id=frameNum
+                          , timestep=Duration(int((t_curr-t_last)/1000), ((t_curr-t_last)%1000)*1e6)
+                          , keypoints=keypoints)
+
+    return pairs, expansions, lastkey
+
+
+def expansionTTC(expansions, timeunit):
+    # timeunit is the length of the frame time unit in seconds
+    dt = (expansions['t1']-expansions['t0'])*timeunit
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return np.where(dt > 0, dt/(expansions['scale']-1), np.nan)
+
+
+def writeResults(frameNum, t_curr, expansions):
+    for e, ttc in zip(expansions, expansionTTC(expansions, tracker.kpHist.timeunit)):
+        results.writerow((frameNum, "%.3f" % t_curr, e['class_id'], "%.2f" % e['x'], "%.2f" % e['y']
+                          , "%.4f" % e['scale'], "%.2f" % e['querySize'], "%.2f" % e['size'], e['detects']
+                          , "%.4f" % ttc, "%.4f" % e['ttc'], "%.4g" % e['ttc_var']))
+
+
+def drawMatches(dispim, pairs):
+    if opts.nodraw: return
+
+    # Draw rectangle around RoI
+    cv2.rectangle(dispim,(scrapX,scrapY)
+                  ,(dispim.shape[1]-scrapX,dispim.shape[0]-scrapY)
+                  ,(192,192,192),thickness=2)
+
+    qkp, tkp = pairs
+    if len(qkp): # Draw matched keypoints
+        cv2.drawKeypoints(dispim, toCvKeyPoints(qkp), dispim, color=(0,255,0))
+        cv2.drawKeypoints(dispim, toCvKeyPoints(tkp), dispim, color=(255,0,0))
+        for q,t in zip(qkp,tkp): cv2.line(dispim, inttuple(q['x'],q['y']), inttuple(t['x'],t['y']), (0,255,0), 1)
+
+
+def drawExpansions(dispim, expansions, framePos=None):
+    if opts.nodraw: return
+
+    # Print out drone status to the image
+    if kbctrl:
+        stat = "BATT=%.2f" % (kbctrl.navdata.batteryPercent)
+        cv2.putText(dispim,stat,(10,dispim.shape[0]-10)
+                    ,cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,0,255))
+    elif framePos is not None:
+        stat = "FRAME %4d/%4d" % (framePos,frmbuf.stop)
+        cv2.putText(dispim,stat,(10,dispim.shape[0]-10)
+                    ,cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,0,255))
+
+    # Draw expanding keypoints with tags
+    if opts.drawtags:
+        for e in expansions:
+            kpinfo = "(%d,%.2f,%.3f)" % (e['class_id'],e['scale'],e['ttc'])
+            cv2.putText(dispim,kpinfo,inttuple(e['x']+e['size']//2,e['y']-e['size']//2)
+                        ,cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255,255,0))
+
+        cv2.drawKeypoints(dispim, toCvKeyPoints(expansions), dispim, color=(0,0,255)
+                          , flags=cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
+
+
+def drawClusters(dispim, clusters):
+    if opts.nodraw: return
+
+    for c in clusters:
+        cv2.rectangle(dispim, inttuple(*c.p0), inttuple(*c.p1), (0,255,255), 1)
+        cv2.circle(dispim, inttuple(*c.pt), 2, (0,255,255), thickness=-1)
+        cv2.putText(dispim, "%.2f" % c.ttc, inttuple(c.p0[0], c.p0[1]-2)
+                    , cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0,255,255))
+
+
+def handleKeys(lastkey, t1_loop):
+    '''
+    Handle input keyboard events. Returns the key pressed.
+    '''
+    if kbctrl:                  # drone keyboard events
+       k = cv2.waitKey(1)%256
+       kbctrl.keyPressEvent(k)
+       if k == ord('f'):
+           try: FlatTrim()
+           except rospy.ServiceException, e: print e
+       elif k == ord('c'):
+           try: Calibrate()
+           except rospy.ServiceException, e: print e
+    elif opts.video:            # video file controls
+       if lastkey in (ord('q'),ord('m')):
+           k = lastkey
+       elif lastkey is not None:
+           k = cv2.waitKey(250)%256
+           while k not in map(ord,('\r','s','q',' ','m','b','f')): k = cv2.waitKey(250)%256
+       elif not frmbuf.live:
+           # limit the loop rate to 10 Hz the hacky way for display purposes
+           t = (time.time()-t1_loop)
+           k = cv2.waitKey(int(max((0.075-t)*1000,1)))%256
+       else:
+           k = cv2.waitKey(1)%256
+
+       # template matching and seeking need the tracker's frame buffer to
+       # themselves
+       if opts.pipeline: return k
+
+       if k == ord('m'):
+           opts.showmatches ^= True
+           if opts.showmatches: cv2.namedWindow(gtemplate_win,cv2.WINDOW_OPENGL|cv2.WINDOW_NORMAL)
+           else:                cv2.destroyWindow(gtemplate_win)
+       while(k == ord('b')):
+           frmbuf.seek(-2)
+           cv2.imshow(gmain_win,frmbuf.grab()[0])
+           k = cv2.waitKey(250)%256
+       while(k == ord('f')):
+           frmbuf.seek(1)
+           cv2.imshow(gmain_win,frmbuf.grab()[0])
+           k = cv2.waitKey(250)%256
+    else:
+       k = cv2.waitKey(1)%256
+    return k
+
 
 # ==========================================================
 # process options and set up defaults
@@ -69,8 +227,81 @@ parser = argparse.ArgumentParser(usage="flownav.py [options]")
 parser.add_argument("-b", "--bag", dest="bag", default=None
                   , help="Use feed from a ROS bagged recording. (don't)")
 
-parser.add_argument("--threshold", dest="threshold", type=float, default=2000.
-                  , help="Set the Hessian threshold for keypoint detection.")
+parser.add_argument("--features", dest="features", default=DEFAULT_ENGINE, choices=ENGINES.keys()
+                    , help="Feature detector and descriptor. ORB, BRISK and AKAZE descriptors are binary. (%(default)s)")
+
+parser.add_argument("--threshold", dest="threshold", type=float, default=None
+                  , help="Set the detection threshold, the Hessian threshold for SURF. (engine default)")
+
+parser.add_argument("--tiles", dest="tiles", default=None
+                    , help="Detect keypoints in parallel over a grid of ROWSxCOLS tiles of the ROI. (off)")
+
+parser.add_argument("--tile-features", dest="tilefeatures", type=int, default=0
+                    , help="Keep at most this many of the strongest keypoints per tile, 0 for all. (%(default)s)")
+
+parser.add_argument("--adapt-threshold", dest="adaptthreshold", default=None, choices=("keypoints","latency")
+                    , help="Adapt the threshold to a keypoint count or to a frame time budget. (off)")
+
+parser.add_argument("--target-keypoints", dest="targetkeypoints", type=int, default=TARGET_N_KP
+                    , help="Keypoints per frame the adaptive threshold aims for. (%(default)s)")
+
+parser.add_argument("--frame-budget", dest="framebudget", type=float, default=100.
+                    , help="Detection, matching and expansion time per frame in ms the adaptive threshold aims for. (%(default)s)")
+
+parser.add_argument("--min-threshold", dest="minthreshold", type=float, default=None
+                    , help="Lowest adaptive threshold. (engine default)")
+
+parser.add_argument("--max-threshold", dest="maxthreshold", type=float, default=None
+                    , help="Highest adaptive threshold. (engine default)")
+
+parser.add_argument("--klt", dest="klt", type=int, default=0
+                    , help="Track keypoints by optical flow and detect them only every this many frames, 0 to detect on every frame. (%(default)s)")
+
+parser.add_argument("--min-tracks", dest="mintracks", type=int, default=20
+                    , help="Detect keypoints whenever fewer than this many are tracked by optical flow. (%(default)s)")
+
+parser.add_argument("--matcher", dest="matcher", default="bf", choices=MATCHERS
+                    , help="Descriptor matcher: brute force, FLANN KD-tree or FLANN LSH (binary descriptors only). (%(default)s)")
+
+parser.add_argument("--matcher-recall", dest="matchrecall", action="store_true", default=False
+                    , help="Measure the matcher's recall against brute force on every frame. (%(default)s)")
+
+parser.add_argument("--match-radius", dest="matchradius", type=float, default=None
+                    , help="Only match keypoints within this many pixels of each other. (off)")
+
+parser.add_argument("--scale-search", dest="scalesearch", default="exhaustive"
+                    , choices=("exhaustive","coarse")
+                    , help="Search every template scale or search coarse to fine. (%(default)s)")
+
+parser.add_argument("--predict-scale", dest="predictscale", action="store_true", default=False
+                    , help="Search mature tracks only around their predicted scale. (%(default)s)")
+
+parser.add_argument("--workers", dest="workers", type=int, default=0
+                    , help="Estimate expansion in this many worker processes, 0 to estimate in process. (%(default)s)")
+
+parser.add_argument("--history-depth", dest="historydepth", type=int, default=HISTORY_DEPTH
+                    , help="Scale estimates kept per keypoint track. (%(default)s)")
+
+parser.add_argument("--cluster", dest="cluster", action="store_true", default=False
+                    , help="Cluster overlapping expanding keypoints and estimate a TTC per cluster. (%(default)s)")
+
+parser.add_argument("--headless", dest="headless", action="store_true", default=False
+                    , help="Process the video file as fast as possible without any display. (%(default)s)")
+
+parser.add_argument("--results", dest="results", default=None
+                    , help="Write the expanding keypoints of every frame to this CSV file.")
+
+parser.add_argument("--stats-period", dest="statsperiod", type=float, default=1.
+                    , help="Seconds between stage latency stats published on /flownav/stats. (%(default)s)")
+
+parser.add_argument("--stats-file", dest="statsfile", default=None
+                    , help="Dump the stage latency stats to this JSON file on exit.")
+
+parser.add_argument("--pipeline", dest="pipeline", action="store_true", default=False
+                    , help="Run detection, tracking and display as pipelined threads. (%(default)s)")
+
+parser.add_argument("--queue-size", dest="queuesize", type=int, default=2
+                    , help="Frames queued between pipeline stages before the oldest is dropped. (%(default)s)")
 
 parser.add_argument("-m", "--draw-matches", dest="showmatches"
                     , action="store_true", default=False
@@ -97,6 +328,9 @@ parser.add_argument("--loop", dest="loop", action="store_true", default=False
 parser.add_argument("--video-topic", dest="camtopic", default="/ardrone"
                     , help="Specify the topic for camera feed (%(default)r).")
 
+parser.add_argument("--compressed", dest="compressed", action="store_true", default=False
+                    , help="Subscribe to the compressed camera feed. (%(default)s)")
+
 parser.add_argument("--video-file", dest="video", default=None
                     , help="Load a video file to test.")
 
@@ -110,9 +344,40 @@ parser.add_argument("--stop", dest="stop", type=int, default=None
                     , help="Stop frame number for video file analysis.")
 
 opts = parser.parse_args()
+engineparams = ENGINES[opts.features]
+if opts.threshold is None: opts.threshold = engineparams.threshold
+if opts.minthreshold is None: opts.minthreshold = engineparams.thresholds[0]
+if opts.maxthreshold is None: opts.maxthreshold = engineparams.thresholds[1]
+if opts.matcher == 'lsh' and not engineparams.binary:
+    parser.error("LSH matching requires binary descriptors, %s descriptors are floating point" % opts.features.upper())
+if opts.matcher == 'kdtree' and engineparams.binary:
+    parser.error("KD-tree matching requires floating point descriptors, %s descriptors are binary" % opts.features.upper())
+if opts.pipeline and opts.showmatches:
+    parser.error("Scale matches can't be drawn in pipeline mode")
+if opts.adaptthreshold and not 0 < opts.minthreshold <= opts.maxthreshold:
+    parser.error("Adaptive thresholds must satisfy 0 < --min-threshold <= --max-threshold")
+if opts.adaptthreshold and (opts.targetkeypoints <= 0 or opts.framebudget <= 0):
+    parser.error("--target-keypoints and --frame-budget must be positive")
+if opts.tiles:
+    try:
+        opts.tiles = tuple(map(int, opts.tiles.lower().split('x')))
+        if len(opts.tiles) != 2 or min(opts.tiles) < 1: raise ValueError
+    except ValueError:
+        parser.error("--tiles must be given as ROWSxCOLS, e.g. 2x2")
+if opts.klt < 0 or opts.mintracks < 0:
+    parser.error("--klt and --min-tracks must not be negative")
+if opts.historydepth < 1:
+    parser.error("--history-depth must be at least 1")
+if opts.headless and not opts.video:
+    parser.error("Headless mode requires a video file")
+if opts.headless:
+    opts.showmatches = False
+    opts.nodraw = True
+# frames are only converted for display when shown or recorded
+display = not opts.headless or opts.record
 
 VERBOSE = 0 if opts.quiet else opts.verbose
-fbuf.VERBOSE = smatch.VERBOSE = VERBOSE
+fbuf.VERBOSE = smatch.VERBOSE = tracking.VERBOSE = VERBOSE
 
 if opts.bag:
     from subprocess import Popen
@@ -125,11 +390,13 @@ if opts.video:
     frmbuf = VideoBuffer(opts.video,opts.start,opts.stop,historysize=LAST_DAY+1
                          , loop=opts.loop)
 else:
-    frmbuf = ROSCamBuffer(opts.camtopic+"/image_raw",historysize=LAST_DAY+1,buffersize=30)
+    frmbuf = ROSCamBuffer(opts.camtopic+"/image_raw"+("/compressed" if opts.compressed else "")
+                          ,historysize=LAST_DAY+1,buffersize=30,compressed=opts.compressed)
 
 # start the node and control loop
-rospy.init_node("flownav", anonymous=False)
+if not opts.headless or opts.publish: rospy.init_node("flownav", anonymous=False)
 datalog = DataLogger() if opts.publish else None
+statslog = StatsLogger(period=opts.statsperiod) if opts.publish else None
 
 kbctrl = None
 if opts.camtopic == "/ardrone" and not opts.video:
@@ -139,35 +406,11 @@ if kbctrl:
     Calibrate = rospy.ServiceProxy("/ardrone/imu_recalib",Empty())
 
 gmain_win = frmbuf.name
-cv2.namedWindow(gmain_win, flags=cv2.WINDOW_OPENGL|cv2.WINDOW_NORMAL)
+if not opts.headless: cv2.namedWindow(gmain_win, flags=cv2.WINDOW_OPENGL|cv2.WINDOW_NORMAL)
 if opts.showmatches: cv2.namedWindow(gtemplate_win, flags=cv2.WINDOW_OPENGL|cv2.WINDOW_NORMAL)
 smatch.MAIN_WIN = gmain_win
 smatch.TEMPLATE_WIN = gtemplate_win
 
-# ==========================================================
-# Additional setup before main loop
-# ==========================================================
-# initialize the feature description and matching methods
-bfmatcher = cv2.BFMatcher()
-surf_ui = cv2.SURF(hessianThreshold=opts.threshold,extended=True,upright=True)
-
-# mask out a central portion of the image
-lastFrame, t_last = frmbuf.grab()
-roi = np.zeros(lastFrame.shape,np.uint8)
-scrapY, scrapX = lastFrame.shape[0]//8, lastFrame.shape[1]//8
-roi[scrapY:-scrapY, scrapX:-scrapX] = True
-
-if opts.record:
-    video_writer = cv2.VideoWriter(opts.record, -1, fps=10,frameSize=lastFrame.shape, isColor=False)
-
-idgen = uniqid_gen()
-getuniqid = lambda : idgen.next()
-queryKP, qdesc = surf_ui.detectAndCompute(lastFrame,roi)
-for kp in queryKP: kp.class_id = getuniqid()
-
-# helper function
-getMatchKPs = lambda x: (queryKP[x.queryIdx],trainKP[x.trainIdx])
-
 # ==========================================================
 # Print intro output to user
 # ==========================================================
@@ -175,7 +418,21 @@ if VERBOSE:
     print "Options"
     print "-"*len("Options")
     print "- Subscribed to", (repr(opts.camtopic) if not opts.video else opts.video)
-    print "- Hessian threshold set at", repr(opts.threshold)
+    print "- Features are", opts.features.upper(), "with the threshold set at", repr(opts.threshold)
+    if opts.adaptthreshold == 'keypoints':
+        print "- Threshold adapted to", opts.targetkeypoints, "keypoints per frame"
+    elif opts.adaptthreshold == 'latency':
+        print "- Threshold adapted to a frame budget of", opts.framebudget, "ms"
+    print "- Descriptor matcher is", opts.matcher
+    if opts.tiles: print "- Keypoints detected over %dx%d tiles" % opts.tiles
+    if opts.klt: print "- Keypoints tracked by optical flow, detected every", opts.klt, "frames or below", opts.mintracks, "tracks"
+    if opts.matchradius: print "- Matches gated to a radius of", opts.matchradius, "pixels"
+    print "- Scale search is", opts.scalesearch
+    if opts.pipeline: print "- Pipelined with queues of", opts.queuesize, "frames"
+    if opts.cluster: print "- Expanding keypoints clustered for a TTC per cluster"
+    if opts.workers: print "- Expansion estimated in", opts.workers, "worker processes"
+    if opts.headless: print "- Running headless"
+    if opts.results: print "- Writing results to", opts.results
     print
 
     if kbctrl:
@@ -185,182 +442,173 @@ if VERBOSE:
             print k.ljust(20),'=',repr(v).ljust(5)
         print
 
-    print "Additional controls"
-    print "-"*len("Additional controls")
-    print "* Press 'q' at any time to quit"
-    print "* Press 'd' at any time to toggle keypoint drawing"
-    if opts.video:
-        print "* Press 'm' at any time to toggle scale matching drawing"
-    if kbctrl:
-        print "* Press 'f' while drone is landed and level to perform a flat trim"
-        print "* Press 'c' when drone is in a stable hover to recalibrate drone's IMU"
+    if not opts.headless:
+        print "Additional controls"
+        print "-"*len("Additional controls")
+        print "* Press 'q' at any time to quit"
+        print "* Press 'd' at any time to toggle keypoint drawing"
+        if opts.video and not opts.pipeline:
+            print "* Press 'm' at any time to toggle scale matching drawing"
+        if kbctrl:
+            print "* Press 'f' while drone is landed and level to perform a flat trim"
+            print "* Press 'c' when drone is in a stable hover to recalibrate drone's IMU"
 
 # ==========================================================
 # Additional setup before main loop
 # ==========================================================
 # initialize the feature description and matching methods
-bfmatcher = cv2.BFMatcher()
-surf_ui = cv2.SURF(hessianThreshold=opts.threshold,extended=True,upright=True)
-
 # mask out a central portion of the image
 lastFrame, t_last = frmbuf.grab()
 roi = np.zeros(lastFrame.shape,np.uint8)
 scrapY, scrapX = lastFrame.shape[0]//4, lastFrame.shape[1]//4
 roi[scrapY:-scrapY, scrapX:-scrapX] = True
 
+if opts.tiles:
+    features = TiledDetector(opts.features, (scrapX, scrapY, roi.shape[1]-scrapX, roi.shape[0]-scrapY)
+                             , opts.tiles, opts.threshold, maxPerTile=opts.tilefeatures)
+else:
+    features = FeatureEngine(opts.features, opts.threshold)
+matcher = DescriptorMatcher(opts.matcher, binary=features.binary, recall=opts.matchrecall, radius=opts.matchradius)
+if opts.adaptthreshold:
+    target = opts.targetkeypoints if opts.adaptthreshold == 'keypoints' else opts.framebudget
+    thresholder = ThresholdController(features, target, opts.adaptthreshold, opts.minthreshold, opts.maxthreshold
+                                      , attr='threshold')
+else:
+    thresholder = None
+
 if opts.record:
     video_writer = cv2.VideoWriter(opts.record, -1, fps=10,frameSize=lastFrame.shape, isColor=False)
 
-idgen = uniqid_gen()
-getuniqid = lambda : idgen.next()
+# in pipeline mode the tracker works on its own copy of the frame history
+# since the detection stage runs ahead of it
+history = FrameHistory(historysize=LAST_DAY+1) if opts.pipeline else frmbuf
+pool = smatch.ResidualPool(lastFrame.shape, opts.workers) if opts.workers else None
+tracker = ExpansionTracker(features, matcher, roi, history, 'L2'
+                           , search=opts.scalesearch, predict=opts.predictscale, pool=pool
+                           , depth=opts.historydepth, ratio=features.ratio, maxdist=features.maxdist
+                           , redetect=max(opts.klt,1), minTracks=opts.mintracks if opts.klt else 0
+                           , timeunit=1e-3 if opts.video else 1.)
 
 # get keypoints and feature descriptors from query image and assign them an id
-queryKP, qdesc = surf_ui.detectAndCompute(lastFrame,roi)
-for kp in queryKP: kp.class_id = getuniqid()
-
-# helper function
-getMatchKPs = lambda x: (queryKP[x.queryIdx],trainKP[x.trainIdx])
+if opts.pipeline: history.push(lastFrame, t_last)
+tracker.reset(lastFrame, t_last)
 
 # ==========================================================
 # main loop
 # ==========================================================
-# errsum = 0
-kpHist = OrderedDict()
-while not rospy.is_shutdown():
-    try:
-        if frmbuf.looped:
-            kpHist.clear()
-            lastFrame, t_last = currFrame, t_curr
-            queryKP, qdesc = surf_ui.detectAndCompute(lastFrame,roi)
-            idgen = uniqid_gen()
-            getuniqid = lambda : idgen.next()
-            for kp in queryKP: kp.class_id = getuniqid()
-            frmbuf.looped = False
-    except AttributeError:
-        pass
-    currFrame, t_curr = frmbuf.grab()
+def grabAndDetect():
+    with timer.time('grab'):
+        currFrame, t_curr = frmbuf.grab()
+    if not currFrame.size: return None
 
-    t1_loop = time.time() # loop timer
-    if not currFrame.size: break
-    dispim = cv2.cvtColor(currFrame,cv2.COLOR_GRAY2BGR)
+    looped = getattr(frmbuf,'looped',False)
+    if looped: frmbuf.looped = False
 
     if VERBOSE > 2: print "Frame time: %8.3f ms" % t_curr
-
-    '''
-    First, assign _every_ query keypoint a unique ID
-    Note: 1 and -1 are the openCV default class_ids
-    '''
-    for kp in queryKP:
-        if kp.class_id in (1,-1): kp.class_id = getuniqid()
-
-    # # attempt to adaptively threshold
-    # err = len(trainKP)-TARGET_N_KP
-    # surf_ui.hessianThreshold += 0.3*(err) + 0.05*(errsum+err)
-    # if surf_ui.hessianThreshold < MIN_THRESH: surf_ui.hessianThreshold = MIN_THRESH
-    # # elif surf_ui.hessianThreshold > MAX_THRESH: surf_ui.hessianThreshold = MAX_THRESH
-    # errsum = len(trainKP)-TARGET_N_KP
-
-    '''
-    Now, define a one to one mapping to the training keypoints
-    '''
-    trainKP, tdesc = surf_ui.detectAndCompute(currFrame,roi)
-
-    # Find the best K matches for each keypoint
-    if tdesc is None or qdesc is None:  matches = []
-    else:                               matches = bfmatcher.knnMatch(qdesc,tdesc,k=2)
-
-    # Filter out poor matches by ratio test , maximum (descriptor) distance
-    matchdist = []
-    filteredmatches = []
-    for m in matches:                           
-        if (len(m)==2 and m[0].distance >= 0.8*m[1].distance) or m[0].distance >= 0.25:
+    if VERBOSE > 2 and isinstance(frmbuf,ROSCamBuffer):
+        print "Frame wait: %6.2f ms, latency: %6.2f ms" % (frmbuf.waitTime*1000, frmbuf.latency*1000)
+
+    # the buffer reuses its frames, so keep a copy for the later stages
+    # with optical flow, whether to detect is only known once the tracker
+    # has caught up, so detection is left to the track stage
+    currFrame = currFrame.copy()
+    trainKP = tdesc = None
+    if not opts.klt:
+        with timer.time('detect'):
+            trainKP, tdesc = tracker.detect(currFrame)
+    framePos = framePosition() if not opts.headless else None
+    return DetectedFrame(currFrame, t_curr, frmbuf.frameNum, framePos, looped, trainKP, tdesc)
+
+def trackDetected(item):
+    history.push(item.img, item.t)
+    detected = item.keypoints is not None
+    if item.looped:
+        tracker.reset(item.img, item.t, features=(item.keypoints, item.descriptors) if detected else None)
+        nokp = np.empty(0, KEYPOINT_DTYPE)
+        return TrackedFrame(item.img, item.t, item.frameNum, item.framePos, (nokp, nokp)
+                            , np.empty(0, tracking.EXPANSION_DTYPE))
+    trainKP, tdesc = item.keypoints, item.descriptors
+    if not detected and tracker.needsDetection():
+        with timer.time('detect'):
+            trainKP, tdesc = tracker.detect(item.img)
+    pairs, expansions, _ = trackFrame(item.t, item.frameNum, trainKP, tdesc)
+    return TrackedFrame(item.img, item.t, item.frameNum, item.framePos, pairs, expansions)
+
+timer = StageTimer()
+results = None
+if opts.results:
+    resultsfile = open(opts.results, 'wb')
+    results = csv.writer(resultsfile)
+    results.writerow(('frame','time','class_id','x','y','scale','querySize','trainSize','detects','ttc','ttc_filtered','ttc_var'))
+
+if opts.pipeline:
+    # Detection of the next frame overlaps with tracking of the current one
+    # and display runs on the main thread. Frames are dropped between stages
+    # when a stage falls behind on a live feed.
+    block = bool(opts.video) and not frmbuf.live
+    detectq = DropOldestQueue(opts.queuesize)
+    renderq = DropOldestQueue(opts.queuesize)
+    stages = [Stage(grabAndDetect, outq=detectq, name="detect", block=block)
+              , Stage(trackDetected, inq=detectq, outq=renderq, name="track", block=block)]
+    for s in stages: s.start()
+
+currFrame, t_curr = lastFrame, t_last
+t1_loop = t_start = time.time()
+nframes = 0
+while not rospy.is_shutdown():
+    if opts.pipeline:
+        item = renderq.get(POLL_PERIOD)
+        for s in stages: s.check()
+        if item is None:
+            if renderq.finished: break
             continue
-        filteredmatches.append(m[0])
-        qkp, tkp = getMatchKPs(m[0])
-        tkp.class_id = qkp.class_id             # carry over the key point's ID
-        matchdist.append(diffKP_L2(qkp,tkp))    # get the match pixel distance
-    matches = filteredmatches
-
-    if matchdist:       # Filter out matches with outlier spatial distances
-        threshdist = np.mean(stats.trim1(matchdist,0.25)) + 2*np.std(matchdist)
-        matches = [m for m,mdist in zip(matches,matchdist) if mdist < threshdist]
-
-    if not opts.nodraw: # Draw rectangle around RoI
-        cv2.rectangle(dispim,(scrapX,scrapY)
-                      ,(currFrame.shape[1]-scrapX,currFrame.shape[0]-scrapY)
-                      ,(192,192,192),thickness=2)
-
-    if not opts.nodraw and matches: # Draw matched keypoints
-        qkp, tkp = zip(*map(getMatchKPs,matches))
-        cv2.drawKeypoints(dispim, qkp, dispim, color=(0,255,0))
-        cv2.drawKeypoints(dispim, tkp, dispim, color=(255,0,0))
-        for q,t in zip(qkp,tkp): cv2.line(dispim, inttuple(*q.pt), inttuple(*t.pt), (0,255,0), 1)
-        
-    '''
-    Find an estimate of the scale change for keypoints that are expanding
-    Then update the history of expanding keypoints
-    '''
-    matches = filter(lambda m: trainKP[m.trainIdx].size > queryKP[m.queryIdx].size, matches)
-    matches, kpscales = smatch.estimateKeypointExpansion(frmbuf, matches, queryKP, trainKP, kpHist, 'L2')
-
-    if opts.showmatches:
-        lastkey = smatch.drawTemplateMatches(frmbuf, matches, queryKP, trainKP
-                                             , kpHist, kpscales, dispim=dispim)
+        currFrame, t_curr, frameNum = item.img, item.t, item.frameNum
+        dispim = None
+        if display:
+            dispim = cv2.cvtColor(currFrame,cv2.COLOR_GRAY2BGR)
+            with timer.time('draw'): drawMatches(dispim, item.pairs)
+        expansions, framePos, lastkey = item.expansions, item.framePos, None
     else:
-        lastkey = None
-
-    keypoints = []
-    for m,scale in zip(matches,kpscales):
-        clsid = trainKP[m.trainIdx].class_id
-        if clsid not in kpHist:
-            kpHist[clsid] = KeyPointHistory()
-            t_A = t_last
-        else:                     
-            t_A = kpHist[clsid].timehist[-1][-1]
-
-        # update matched expanding keypoints with accurate scale, latest
-        # keypoint and descriptor
-        kpHist[clsid].update(trainKP[m.trainIdx],tdesc[m.trainIdx],t_A,t_curr,scale)
-
-        keypoints.append(kpMsg(x=trainKP[m.trainIdx].pt[0]
-                               , y=trainKP[m.trainIdx].pt[1]
-                               , scale=scale, class_id=clsid
-                               , detects=kpHist[clsid].detects
-                               , trainSize=trainKP[m.trainIdx].size
-                               , querySize=queryKP[m.queryIdx].size))
-    if opts.publish:
-        keypoints=sorted(keypoints, key=op.attrgetter('scale','detects'), reverse=True)[:10]
-        datalog.write(frame_id=frmbuf.frameNum
-                      , timestep=Duration(int((t_curr-t_last)/1000), ((t_curr-t_last)%1000)*1e6)
-                      , keypoints=keypoints)
-        
-    # Update the keypoint history for previously expanding keypoint that were
-    # not detected/matched in this frame
-    detected = set(map(op.attrgetter('class_id'),trainKP))
-
-    # get rid of old matches
-    kpHist = OrderedDict(filter(lambda kv: kv[1].downdate().age < LAST_DAY, kpHist.iteritems()))
-
-    # keep matches that were missed in this frame
-    missed = filter(lambda k: (kpHist[k].age > 0) and (k not in detected), kpHist.iterkeys())
-    missed = [(kpHist[k].keypoint,kpHist[clsid].descriptor.reshape(1,-1)) for k in missed]
-    if missed:
-        missed_kp, missed_desc = zip(*missed)
-        trainKP.extend( missed_kp )
-        tdesc = missed_desc[0] if tdesc is None else np.r_[tdesc, missed_desc[0]]
+        if getattr(frmbuf,'looped',False):
+            tracker.reset(currFrame, t_curr)
+            frmbuf.looped = False
+        with timer.time('grab'):
+            currFrame, t_curr = frmbuf.grab()
+        frameNum = frmbuf.frameNum
+
+        t1_loop = time.time() # loop timer
+        if not currFrame.size: break
+        dispim = cv2.cvtColor(currFrame,cv2.COLOR_GRAY2BGR) if display else None
+
+        if VERBOSE > 2: print "Frame time: %8.3f ms" % t_curr
+        if VERBOSE > 2 and isinstance(frmbuf,ROSCamBuffer):
+            print "Frame wait: %6.2f ms, latency: %6.2f ms" % (frmbuf.waitTime*1000, frmbuf.latency*1000)
+
+        trainKP = tdesc = None
+        if tracker.needsDetection():
+            with timer.time('detect'):
+                trainKP, tdesc = tracker.detect(currFrame)
+        pairs, expansions, lastkey = trackFrame(t_curr, frameNum, trainKP, tdesc
+                                                , dispim=None if opts.headless else dispim)
+        framePos = framePosition() if not opts.headless else None
+    nframes += 1
+    if results: writeResults(frameNum, t_curr, expansions)
 
     '''
     Finally, perform some simple clustering of adjacent keypoints to
     obtain a more accurate estimate of TTC
     '''
-    # cluster keypoints and sort my maximum inter-cluster distance
-    # ttc_cluster = []
-    # expandingKPs = filter(lambda x: (x.class_id in kpHist) and (kpHist[x.class_id].age == 0), trainKP)
-    # cluster = ClusterKeypoints(expandingKPs, kpHist, currFrame)
-    # for c in cluster:
-    #     tstep = np.array( [op.sub(*reversed(kpHist[kp.class_id].timehist[-1])) for kp in c.KPs] )
-    #     scale = np.array( [kpHist[kp.class_id].scalehist[-1] for kp in c.KPs] )
-    #     ttc_cluster.append(np.median(tstep / scale))
+    # cluster expanding keypoints, largest cluster first
+    cluster = []
+    if opts.cluster:
+        with timer.time('cluster'):
+            cluster = clusterKeypoints(expansions, currFrame.shape)
+            for c in cluster:
+                ttc = c.KPs['ttc'][np.isfinite(c.KPs['ttc'])]
+                c.ttc = np.median(ttc) if ttc.size else float('nan')
+        timer.tally('clusters', len(cluster))
+        if VERBOSE > 1:
+            for c in cluster: print "Cluster at (%d,%d): %2d keypoints, TTC %.3f s" % (c.pt+(len(c.KPs),c.ttc))
 
     # if kbctrl and cluster:
     #     c = cluster[0]
@@ -368,106 +616,46 @@ while not rospy.is_shutdown():
     #     if (x_obs-currFrame.shape[1]//2) < 0: kbctrl.RollRight()
     #     if x_obs >= currFrame.shape[1]//2: kbctrl.RollLeft()
 
-    # Print out drone status to the image
-    if not opts.nodraw:
-        if kbctrl:
-            stat = "BATT=%.2f" % (kbctrl.navdata.batteryPercent)
-            cv2.putText(dispim,stat,(10,currFrame.shape[0]-10)
-                        ,cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,0,255))
-        elif opts.video and not frmbuf.live:
-            stat = "FRAME %4d/%4d" % (frmbuf.cap.get(cv2.CAP_PROP_POS_FRAMES),frmbuf.stop)
-            cv2.putText(dispim,stat,(10,currFrame.shape[0]-10)
-                        ,cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,0,255))
-
-    # Draw expanding keypoints with tags
-    if not opts.nodraw and opts.drawtags:
-        expandingKPs = []
-        for m in matches:
-            qkp = queryKP[m.queryIdx]
-            tkp = trainKP[m.trainIdx]
-            scale = kpHist[tkp.class_id].scalehist[-1]
-            tstep = -np.diff(kpHist[tkp.class_id].timehist[-1])
-            # tstep = 1
-            ttc = tstep / scale
-
-            kpinfo = "(%d,%.2f,%.3f)" % (tkp.class_id,scale,ttc)
-            cv2.putText(dispim,kpinfo,inttuple(tkp.pt[0]+tkp.size//2,tkp.pt[1]-tkp.size//2)
-                        ,cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255,255,0))
-            expandingKPs.append(kpHist[tkp.class_id].keypoint)
-
-        cv2.drawKeypoints(dispim, expandingKPs, dispim, color=(0,0,255)
-                          , flags=cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
+    if statslog: statslog.write(frameNum, timer)
 
-        # # Draw clusters with tags
-        # votes = [sum(kpHist[kp.class_id].detects for kp in c.KPs) for c in cluster]
-        # for c, ttc in zip(cluster,ttc_cluster):
-        #     clustinfo = "(%d,%.2f)" % (len(c.KPs),ttc)
-        #     cv2.putText(dispim,clustinfo,(c.p1[0]-5,c.p1[1])
-        #                 ,cv2.FONT_HERSHEY_SIMPLEX, 0.3, (0,0,255))
-
-        #     # Draw an arrow denoting the direction to avoid obstacle
-        #     x_obs, y = c.pt
-        #     if (x_obs-(currFrame.shape[1]//2)) < 0: offset = 50
-        #     if x_obs >= (currFrame.shape[1]//2):    offset = -50
-        #     cv2.arrowedLine(dispim, (currFrame.shape[1]//2,currFrame.shape[0] - 50)
-        #                     , (currFrame.shape[1]//2+offset,currFrame.shape[0] - 50)
-        #                     , (0,255,0), 3)
-
-        #     # draw cluster ranking
-        #     clr = (0,255-sum(kpHist[kp.class_id].detects for kp in c.KPs)*165./max(votes),255)
-        #     cv2.rectangle(dispim,c.p0,c.p1,color=clr,thickness=2)
+    if not opts.headless:
+        # the matches were drawn under 'draw' already
+        with timer.time('overlay'):
+            drawExpansions(dispim, expansions, framePos)
+            drawClusters(dispim, cluster)
 
-    '''
-    Handle input keyboard events
-    '''
-    cv2.imshow(gmain_win, dispim)
-    if kbctrl:                  # drone keyboard events
-       k = cv2.waitKey(1)%256        
-       kbctrl.keyPressEvent(k)
-       if k == ord('f'):
-           try: FlatTrim()
-           except rospy.ServiceException, e: print e
-       elif k == ord('c'):
-           try: Calibrate()
-           except rospy.ServiceException, e: print e
-    elif opts.video:            # video file controls
-       if lastkey in (ord('q'),ord('m')):
-           k = lastkey
-       elif lastkey is not None:
-           k = cv2.waitKey(250)%256
-           while k not in map(ord,('\r','s','q',' ','m','b','f')): k = cv2.waitKey(250)%256
-       elif not frmbuf.live:
-           # limit the loop rate to 10 Hz the hacky way for display purposes
-           t = (time.time()-t1_loop)
-           k = cv2.waitKey(int(max((0.075-t)*1000,1)))%256
-       else:
-           k = cv2.waitKey(1)%256
-       if k == ord('m'):
-           opts.showmatches ^= True
-           if opts.showmatches: cv2.namedWindow(gtemplate_win,cv2.WINDOW_OPENGL|cv2.WINDOW_NORMAL)
-           else:                cv2.destroyWindow(gtemplate_win)
-       while(k == ord('b')):
-           frmbuf.seek(-2)
-           cv2.imshow(gmain_win,frmbuf.grab()[0])
-           k = cv2.waitKey(250)%256
-       while(k == ord('f')):
-           frmbuf.seek(1)
-           cv2.imshow(gmain_win,frmbuf.grab()[0])
-           k = cv2.waitKey(250)%256
-    if k == ord('d'): opts.nodraw ^= True
-    if k == ord('q'): break
+        cv2.imshow(gmain_win, dispim)
+        k = handleKeys(lastkey, t1_loop)
+        t1_loop = time.time()
+        if k == ord('d'): opts.nodraw ^= True
+        if k == ord('q'): break
 
     if opts.record: video_writer.write(dispim)
+t_elapsed = time.time()-t_start
+
+if opts.pipeline:
+    for s in stages: s.stop()
+    for s in stages: s.join(1.)
+    for s in stages: s.check()
+    if VERBOSE:
+        for s, q in zip(stages, (detectq, renderq)):
+            print "Stage %-6s: %5d frames, %6.2f ms/frame, %d dropped downstream" \
+                % (s.name, s.count, s.busyTime/max(s.count,1)*1000, q.dropped)
+
+if VERBOSE and opts.headless:
+    print
+    print "Processed %d frames in %.2f s (%.2f fps)" % (nframes, t_elapsed, nframes/max(t_elapsed,1e-9))
+    for line in timer.report(): print line
 
-    # shift the buffer of loop data
-    lastFrame   = currFrame
-    queryKP     = trainKP
-    qdesc       = tdesc
-    t_last      = t_curr
+if opts.statsfile:
+    with open(opts.statsfile, 'w') as f: json.dump(timer.summary(), f, indent=2)
 
 # clean up
+if results: resultsfile.close()
+if pool: pool.close()
+if opts.tiles: features.close()
 if opts.bag: bagp.kill()
 if opts.record: video_writer.release()
 if kbctrl: kbctrl.close()
-cv2.destroyAllWindows()
+if not opts.headless: cv2.destroyAllWindows()
 frmbuf.close()
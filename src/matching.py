@@ -0,0 +1,172 @@
+import time
+import cv2
+import numpy as np
+
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH = 6
+
+KDTREE_TREES = 4
+LSH_TABLES = 6
+LSH_KEY_SIZE = 12
+LSH_PROBES = 1
+FLANN_CHECKS = 32
+GATE_BLOCK_QUERIES = 32 # queries matched per block by gatedKnnMatch
+
+MATCHERS = ('bf','kdtree','lsh')
+
+
+def createMatcher(name='bf', binary=False):
+    '''
+    Create an OpenCV descriptor matcher by name: 'bf' for brute force,
+    'kdtree' for a FLANN randomized KD-tree forest (float descriptors) or
+    'lsh' for FLANN locality sensitive hashing (binary descriptors).
+    '''
+    if name == 'bf':
+        return cv2.BFMatcher(cv2.NORM_HAMMING if binary else cv2.NORM_L2)
+    elif name == 'kdtree':
+        return cv2.FlannBasedMatcher(dict(algorithm=FLANN_INDEX_KDTREE, trees=KDTREE_TREES)
+                                     , dict(checks=FLANN_CHECKS))
+    elif name == 'lsh':
+        return cv2.FlannBasedMatcher(dict(algorithm=FLANN_INDEX_LSH, table_number=LSH_TABLES
+                                          , key_size=LSH_KEY_SIZE, multi_probe_level=LSH_PROBES)
+                                     , dict(checks=FLANN_CHECKS))
+    raise ValueError("Unknown matcher %r" % name)
+
+
+def _noMatches(k):
+    return np.empty(0, np.intp), np.empty((0,k), np.intp), np.empty((0,k))
+
+
+def knnArrays(matches, k=2):
+    '''
+    Turn knnMatch style lists of cv2.DMatch into arrays: the query index of
+    every list and the train indices and distances of its k nearest
+    neighbors, padded with -1 and inf where a query has fewer.
+    '''
+    queryIdx, trainIdx, distance = _noMatches(k)
+    if not matches: return queryIdx, trainIdx, distance
+
+    queryIdx = np.array([m[0].queryIdx for m in matches], np.intp)
+    trainIdx = np.full((len(matches),k), -1, np.intp)
+    distance = np.full((len(matches),k), np.inf)
+    for i,m in enumerate(matches):
+        for j,d in enumerate(m[:k]):
+            trainIdx[i,j], distance[i,j] = d.trainIdx, d.distance
+    return queryIdx, trainIdx, distance
+
+
+def gatedKnnMatch(qdesc, tdesc, queryPts, trainPts, radius, k=2, binary=False):
+    '''
+    Brute force k nearest neighbor matching restricted to the train
+    descriptors whose keypoint lies within radius pixels of the query
+    keypoint.
+
+    The keypoints are bucketed into a grid of radius sized cells. The
+    queries of a block of cells are matched at once against the train
+    keypoints of the block and its neighboring cells with cv2.batchDistance,
+    which masks out the pairs beyond the radius and keeps the k nearest.
+    Returns the matches of the queries that have at least one candidate as
+    knnArrays does.
+    '''
+    qpts = np.asarray(queryPts, np.float64).reshape(-1,2)
+    tpts = np.asarray(trainPts, np.float64).reshape(-1,2)
+    if not len(qpts) or not len(tpts): return _noMatches(k)
+
+    if binary:
+        normType, dtype, nodist = cv2.NORM_HAMMING, cv2.CV_32S, np.iinfo(np.int32).max
+    else:
+        normType, dtype, nodist = cv2.NORM_L2, cv2.CV_32F, np.finfo(np.float32).max
+        qdesc, tdesc = np.asarray(qdesc, np.float32), np.asarray(tdesc, np.float32)
+
+    # cells are shifted by one so that neighboring cells are never negative
+    qcell = np.floor(qpts/radius).astype(np.int64) + 1
+    tcell = np.floor(tpts/radius).astype(np.int64) + 1
+    height = max(qcell[:,1].max(), tcell[:,1].max()) + 2
+    tkey = tcell[:,0]*height + tcell[:,1]
+    torder = np.argsort(tkey, kind='mergesort')
+    tkey = tkey[torder]
+
+    # queries are matched in blocks of g x g cells, large enough to keep
+    # about GATE_BLOCK_QUERIES queries per cv2 call
+    qkey = qcell[:,0]*height + qcell[:,1]
+    density = len(qpts) / float(len(np.unique(qkey)))
+    g = max(1, int(round(np.sqrt(GATE_BLOCK_QUERIES/density))))
+    bkey = (qcell[:,0]//g)*height + qcell[:,1]//g
+    qorder = np.argsort(bkey, kind='mergesort')
+    blocks, start = np.unique(bkey[qorder], return_index=True)
+
+    # the train cells around a block, one range of consecutive keys per
+    # column of cells
+    bx, by = blocks//height, blocks%height
+    rows = np.clip(by*g-1, 0, height-1), np.clip(by*g+g, 0, height-1)
+    lo = [np.searchsorted(tkey, (bx*g+dx)*height+rows[0], 'left') for dx in range(-1,g+1)]
+    hi = [np.searchsorted(tkey, (bx*g+dx)*height+rows[1], 'right') for dx in range(-1,g+1)]
+
+    trainIdx = np.full((len(qpts),k), -1, np.intp)
+    distance = np.full((len(qpts),k), np.inf)
+    for b,qs in enumerate(np.split(qorder, start[1:])):
+        ts = np.sort(np.concatenate([torder[l[b]:h[b]] for l,h in zip(lo,hi)]))
+        if not ts.size: continue
+        near = np.sum((qpts[qs].reshape(-1,1,2)-tpts[ts])**2, axis=2) <= radius**2
+        # batchDistance returns no more neighbors than there are candidates,
+        # the others stay -1 and inf
+        nk = min(k, ts.size)
+        dist, nidx = cv2.batchDistance(qdesc[qs], tdesc[ts], dtype, normType=normType, K=nk
+                                       , mask=near.astype(np.uint8))
+        found = nidx >= 0
+        trainIdx[qs,:nk] = np.where(found, ts[nidx], -1)
+        distance[qs,:nk] = np.where(found & (dist < nodist), dist, np.inf)
+
+    queryIdx = np.flatnonzero(trainIdx[:,0] >= 0)
+    return queryIdx, trainIdx[queryIdx], distance[queryIdx]
+
+
+class DescriptorMatcher(object):
+    '''
+    DescriptorMatcher
+
+    Wraps one of the OpenCV matchers behind knnMatch and keeps the time
+    taken by the last match. If recall is set, every match is repeated with
+    brute force and the fraction of query descriptors for which both agree
+    on the nearest neighbor is kept as well. If radius is set and keypoint
+    positions are passed to knnMatch, matching is gated to train keypoints
+    within radius pixels of each query keypoint.
+
+    knnMatch returns the matches as arrays of query indices and of the train
+    indices and distances of their k nearest neighbors (see knnArrays).
+    '''
+    def __init__(self, name='bf', binary=False, recall=False, radius=None):
+        if name == 'lsh' and not binary:
+            raise ValueError("LSH matching requires binary descriptors")
+        self.name = name
+        self.binary = binary
+        self.radius = radius
+        self.matcher = createMatcher(name, binary)
+        self.reference = createMatcher('bf', binary) if recall and (name != 'bf' or radius) else None
+        self.matchTime = 0.
+        self.recall = 1. if recall else None
+
+    def knnMatch(self, qdesc, tdesc, k=2, queryPts=None, trainPts=None):
+        if qdesc is None or tdesc is None or not len(qdesc) or not len(tdesc):
+            self.matchTime = 0.
+            return _noMatches(k)
+
+        # FLANN fails when asked for more neighbors than there are
+        # descriptors to match against
+        k = min(k, len(tdesc))
+
+        t0 = time.time()
+        if self.radius and queryPts is not None and trainPts is not None:
+            queryIdx, trainIdx, distance = gatedKnnMatch(qdesc, tdesc, queryPts, trainPts, self.radius, k, self.binary)
+        else:
+            queryIdx, trainIdx, distance = knnArrays([m for m in self.matcher.knnMatch(qdesc, tdesc, k=k) if m], k)
+        self.matchTime = time.time() - t0
+
+        if self.reference is not None:
+            nearest = np.full(len(qdesc), -1, np.intp)
+            nearest[queryIdx] = trainIdx[:,0]
+            truthQuery, truthTrain, _ = knnArrays([m for m in self.reference.knnMatch(qdesc, tdesc, k=1) if m], 1)
+            hits = np.count_nonzero(nearest[truthQuery] == truthTrain[:,0])
+            self.recall = hits / float(len(truthQuery)) if len(truthQuery) else 1.
+
+        return queryIdx, trainIdx, distance
@@ -0,0 +1,117 @@
+import sys
+import threading
+import time
+from collections import deque
+
+POLL_PERIOD = 0.1 # seconds between checks for shutdown while waiting
+
+
+class DropOldestQueue(object):
+    '''
+    DropOldestQueue
+
+    A bounded queue between two pipeline stages. When the queue is full, put
+    drops the oldest item so that a slow consumer never stalls its producer,
+    unless block is set, in which case put waits for room instead. The
+    number of dropped items is kept in dropped.
+    '''
+    def __init__(self,maxsize=1):
+        self._items = deque()
+        self._maxsize = maxsize
+        self._cond = threading.Condition()
+        self._closed = False
+        self.dropped = 0
+
+    @property
+    def finished(self):
+        # closed and drained
+        return self._closed and not self._items
+
+    def put(self,item,block=False):
+        with self._cond:
+            while block and len(self._items) >= self._maxsize and not self._closed:
+                self._cond.wait(POLL_PERIOD)
+            if len(self._items) >= self._maxsize:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self._cond.notify_all()
+
+    def get(self,timeout=None):
+        '''
+        Remove and return the oldest item, waiting at most timeout seconds
+        (forever if None) for one. None is returned on timeout or once the
+        queue is finished.
+        '''
+        t0 = time.time()
+        with self._cond:
+            while not self._items and not self._closed:
+                remaining = POLL_PERIOD if timeout is None else min(POLL_PERIOD,timeout-(time.time()-t0))
+                if remaining <= 0: return None
+                self._cond.wait(remaining)
+            if not self._items: return None
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class Stage(threading.Thread):
+    '''
+    Stage
+
+    Runs fn on its own thread for every item taken from inq and puts the
+    results on outq. Results of None are not passed on. A stage without an
+    input queue is a source: fn is called without arguments until it
+    returns None.
+
+    The output queue is closed when the stage finishes so that downstream
+    stages wind down in turn. An exception raised by fn stops the stage and
+    is kept in error, to be raised again by check from the main thread.
+    '''
+    def __init__(self,fn,inq=None,outq=None,name=None,block=False):
+        threading.Thread.__init__(self,name=name)
+        self.daemon = True
+        self.fn = fn
+        self.inq = inq
+        self.outq = outq
+        self.block = block
+        self.error = None
+        self.count = 0
+        self.busyTime = 0.
+        self._stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stopped.is_set():
+                if self.inq is None:
+                    t0 = time.time()
+                    item = self.fn()
+                    if item is None: break
+                else:
+                    item = self.inq.get(POLL_PERIOD)
+                    if item is None:
+                        if self.inq.finished: break
+                        continue
+                    t0 = time.time()
+                    item = self.fn(item)
+                self.busyTime += time.time()-t0
+                self.count += 1
+                if item is not None and self.outq is not None:
+                    self.outq.put(item,self.block)
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            if self.outq is not None: self.outq.close()
+
+    def stop(self):
+        self._stopped.set()
+        if self.outq is not None: self.outq.close()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
@@ -1,3 +1,6 @@
+import multiprocessing as mp
+from multiprocessing.sharedctypes import RawArray
+import ctypes
 import cv2
 import numpy as np
 from common import *
@@ -9,48 +12,44 @@ SEARCH_RES = 20
 MINSIZE = 1.2
 scalerange = 1 + np.arange(SEARCH_RES+1)/float(2*SEARCH_RES)
 KEYPOINT_SCALE = (MINSIZE*SEARCH_RES)/9
-
-# need to check for overflow on multiply operations
-def normalize(src,ksize=(8,8)):
-    I = src.astype(np.float64)
-    I_mean = cv2.blur(I,ksize,borderType=cv2.BORDER_REFLECT)
-    I_var = cv2.blur(I**2,ksize,borderType=cv2.BORDER_REFLECT).astype(np.float64) - I_mean**2
-    
-    return (I - I_mean)/np.sqrt(I_var)
+MAX_BATCH_SAMPLES = 2**18 # max samples in one vectorized template matching pass
+COARSE_STEP = 5 # scale index step of the first coarse to fine search pass
+MIN_TRACK_DETECTS = 3 # detects before a track's scale is predicted
+TRACK_WINDOW = 3 # scale steps searched on either side of a predicted scale
+POOL_PATCH_CAPACITY = 2**20 # query patch samples held in a ResidualPool's shared memory
+POOL_TIMEOUT = 3600 # seconds; waits on the pool must time out to stay interruptible
 
 def drawTemplateMatches(frmbuf,matches,queryKPs,trainKPs,kphist,scales,dispim=None):
     tdispim = dispim.copy() if dispim is not None else frmbuf.grab(0)[0].copy()
 
     k = None
     trainImg = frmbuf.grab(0)[0]
-    prevImg = frmbuf.grab(-1)[0]
-    for m,scale in zip(matches,scales):
-        qkp = queryKPs[m.queryIdx]
-        tkp = trainKPs[m.trainIdx]
+    trainStats = frmbuf.grabStats(0)
+    lastFrameIdx = kphist.get(queryKPs['class_id'][matches['queryIdx']], 'lastFrameIdx', -1)
+    for m,scale,queryIdx in zip(matches,scales,lastFrameIdx):
+        qkp = queryKPs[m['queryIdx']]
+        tkp = trainKPs[m['trainIdx']]
 
         # grab the frame where the keypoint was last detected
-        if qkp.class_id in kphist:
-            queryImg = frmbuf.grab(kphist[qkp.class_id].lastFrameIdx)[0]
-        else:
-            queryImg = prevImg
+        queryImg = frmbuf.grab(queryIdx)[0]
 
         # /* Extract the query and train image patch and normalize them. */ #
-        x_qkp,y_qkp = qkp.pt
-        r = qkp.size*KEYPOINT_SCALE // 2
-        x0,y0 = trunc_coords(queryImg.shape,(x_qkp-r, y_qkp-r))
-        x1,y1 = trunc_coords(queryImg.shape,(x_qkp+r, y_qkp+r))
-        querypatch = queryImg[y0:y1, x0:x1]
-        querypatch = (querypatch-np.mean(querypatch))/np.std(querypatch)
+        x_qkp,y_qkp = qkp['x'],qkp['y']
+        r = qkp['size']*KEYPOINT_SCALE // 2
+        x0,y0 = map(int,trunc_coords(queryImg.shape,(x_qkp-r, y_qkp-r)))
+        x1,y1 = map(int,trunc_coords(queryImg.shape,(x_qkp+r, y_qkp+r)))
+        q_mean, q_std = frmbuf.grabStats(queryIdx).meanStd(x0,y0,x1,y1)
+        querypatch = (queryImg[y0:y1, x0:x1]-q_mean)/q_std
 
-        x_tkp,y_tkp = tkp.pt
-        r = qkp.size*KEYPOINT_SCALE*scalerange[-1] // 2        
-        x0,y0 = trunc_coords(trainImg.shape,(x_tkp-r, y_tkp-r))
-        x1,y1 = trunc_coords(trainImg.shape,(x_tkp+r, y_tkp+r))
-        trainpatch = trainImg[y0:y1, x0:x1]
-        trainpatch = (trainpatch-np.mean(trainpatch))/np.std(trainpatch)
+        x_tkp,y_tkp = tkp['x'],tkp['y']
+        r = qkp['size']*KEYPOINT_SCALE*scalerange[-1] // 2        
+        x0,y0 = map(int,trunc_coords(trainImg.shape,(x_tkp-r, y_tkp-r)))
+        x1,y1 = map(int,trunc_coords(trainImg.shape,(x_tkp+r, y_tkp+r)))
+        t_mean, t_std = trainStats.meanStd(x0,y0,x1,y1)
+        trainpatch = (trainImg[y0:y1, x0:x1]-t_mean)/t_std
 
         # recalculate the best matching scaled template
-        r = qkp.size*KEYPOINT_SCALE*scale // 2
+        r = qkp['size']*KEYPOINT_SCALE*scale // 2
         x_tkp,y_tkp = x_tkp-x0,y_tkp-y0
         x0,y0 = trunc_coords(trainpatch.shape,(x_tkp-r, y_tkp-r))
         x1,y1 = trunc_coords(trainpatch.shape,(x_tkp+r, y_tkp+r))
@@ -74,7 +73,7 @@ def drawTemplateMatches(frmbuf,matches,queryKPs,trainKPs,kphist,scales,dispim=No
         drawInto(scaledquery,templimg,tl=(querypatch.shape[1],0))
         drawInto(scaledtrain,templimg,tl=(querypatch.shape[1]+scaledquery.shape[1],0))
 
-        cv2.drawKeypoints(tdispim,[tkp], tdispim, color=(0,0,255)
+        cv2.drawKeypoints(tdispim,toCvKeyPoints([tkp]), tdispim, color=(0,0,255)
                           ,flags=cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
 
         cv2.imshow(TEMPLATE_WIN, templimg.astype(np.uint8))
@@ -95,100 +94,397 @@ def drawTemplateMatches(frmbuf,matches,queryKPs,trainKPs,kphist,scales,dispim=No
     return k
 
 
-def estimateKeypointExpansion(frmbuf, matches, queryKPs, trainKPs, kphist, method='L2sq'):
-    scale_argmin = []
-    expandingMatches = []
+def extractPatches(frmbuf, matches, queryKPs, trainKPs, kphist):
+    """
+    Gather the normalized query patch and the train patch geometry for every
+    match of the MATCH_DTYPE array matches. Matches whose patches are empty
+    or flat are dropped, as the per-scale search had nothing but nan
+    residuals for them.
 
-    res = np.zeros(len(scalerange))
-    trainImg = frmbuf.grab(0)[0]
-    prevImg = frmbuf.grab(-1)[0]
-    for m in matches:
-        qkp = queryKPs[m.queryIdx]
-        tkp = trainKPs[m.trainIdx]
+    Returns the kept matches, the list of query patches, the template size
+    of each match at unit scale, the train keypoint centers and the
+    (mean,std) of the train patch at the largest scale.
+    """
+    kept, querypatches, sizes, centers, tstats = [], [], [], [], []
+
+    trainShape = frmbuf.grab(0)[0].shape
+    trainStats = frmbuf.grabStats(0)
+    lastFrameIdx = kphist.get(queryKPs['class_id'][matches['queryIdx']], 'lastFrameIdx', -1)
+    for i,(m,queryIdx) in enumerate(zip(matches,lastFrameIdx)):
+        qkp = queryKPs[m['queryIdx']]
+        tkp = trainKPs[m['trainIdx']]
 
         # grab the frame where the keypoint was last detected
-        if qkp.class_id in kphist:
-            queryImg = frmbuf.grab(kphist[qkp.class_id].lastFrameIdx)[0]
-        else:
-            queryImg = prevImg
-
-        # Extract the query and train image patch and normalize them
-        x_qkp,y_qkp = qkp.pt
-        r = qkp.size * KEYPOINT_SCALE // 2
-        x0,y0 = trunc_coords(queryImg.shape,(x_qkp-r, y_qkp-r))
-        x1,y1 = trunc_coords(queryImg.shape,(x_qkp+r, y_qkp+r))
+        queryImg = frmbuf.grab(queryIdx)[0]
+
+        x_qkp,y_qkp = qkp['x'],qkp['y']
+        r = qkp['size']*KEYPOINT_SCALE // 2
+        x0,y0 = map(int,trunc_coords(queryImg.shape,(x_qkp-r, y_qkp-r)))
+        x1,y1 = map(int,trunc_coords(queryImg.shape,(x_qkp+r, y_qkp+r)))
+        if x1 <= x0 or y1 <= y0: continue
+        q_mean, q_std = frmbuf.grabStats(queryIdx).meanStd(x0,y0,x1,y1)
+        if not q_std: continue
+
+        x_tkp,y_tkp = tkp['x'],tkp['y']
+        r = qkp['size']*KEYPOINT_SCALE*scalerange[-1] // 2
+        tx0,ty0 = map(int,trunc_coords(trainShape,(x_tkp-r, y_tkp-r)))
+        tx1,ty1 = map(int,trunc_coords(trainShape,(x_tkp+r, y_tkp+r)))
+        if tx1 <= tx0 or ty1 <= ty0: continue
+        t_mean, t_std = trainStats.meanStd(tx0,ty0,tx1,ty1)
+        if not t_std: continue
+
         querypatch = queryImg[y0:y1, x0:x1]
-        if not querypatch.size: continue
-        querypatch = (querypatch-np.mean(querypatch))/np.std(querypatch)
-
-        x_tkp,y_tkp = tkp.pt
-        r = qkp.size*KEYPOINT_SCALE*scalerange[-1] // 2
-        x0,y0 = trunc_coords(trainImg.shape,(x_tkp-r, y_tkp-r))
-        x1,y1 = trunc_coords(trainImg.shape,(x_tkp+r, y_tkp+r))
-        trainpatch = trainImg[y0:y1, x0:x1]
-        if not trainpatch.size: continue
-        trainpatch = (trainpatch-np.mean(trainpatch))/np.std(trainpatch)
-
-        # Scale up the query to perform template matching
-        res[:] = np.nan
-        x_tkp,y_tkp = x_tkp-x0,y_tkp-y0
-        for i,scale in enumerate(scalerange):
-            r = qkp.size*KEYPOINT_SCALE*scale // 2
-            x0,y0 = trunc_coords(trainpatch.shape,(x_tkp-r, y_tkp-r))
-            x1,y1 = trunc_coords(trainpatch.shape,(x_tkp+r, y_tkp+r))
-            scaledtrain = trainpatch[y0:y1, x0:x1]
-            if not scaledtrain.size: continue
-
-            scaledquery = cv2.resize(querypatch,scaledtrain.shape[::-1]
-                                     , fx=scale, fy=scale
-                                     , interpolation=cv2.INTER_LINEAR)
-
-            if method == 'corr':
-                res[i] = np.sum(scaledquery*scaledtrain)
-            elif method == 'L1':
-                res[i] = np.sum(np.abs(scaledquery-scaledtrain))
-            elif method == 'L2':
-                res[i] = np.sqrt(np.sum((scaledquery-scaledtrain)**2))
-            elif method == 'L2sq':
-                res[i] = np.sum((scaledquery-scaledtrain)**2)
-        if all(np.isnan(res)): continue
-        res /= scalerange**2 # normalize over scale
-
-        # determine if the min match is acceptable
-        res_argmin = np.nanargmin(res)
-        scalemin = scalerange[res_argmin]
-        if (scalemin > MINSIZE) and (res[res_argmin] < 0.8*res[0]):
-            scale_argmin.append(scalemin)
-            expandingMatches.append(m)
-            if VERBOSE > 1:
-                print
-                print "class_id:",qkp.class_id
-                print "scale_range =", repr(scalerange)[6:-1]
-                # print "residuals =", repr((res-np.nanmin(res))/(np.nanmax(res)-np.nanmin(res)))[6:-1]
-                print "residuals =", repr(res)[6:-1]
-                print "Number of previous detects:", kphist[qkp.class_id].detects if qkp.class_id in kphist else 0
-                # print "Number of previous scale estimates:", len(kphist[qkp.class_id].scalehist) if qkp.class_id in kphist else 1
-                print "Frames since last detect:", abs(kphist[qkp.class_id].lastFrameIdx) if qkp.class_id in kphist else 1
-                # print "Frames since first detect:", kphist[qkp.class_id].age+1 if qkp.class_id in kphist else 1
-                print "Template size =", querypatch.shape
-                print "Relative scaling of template:",scalemin
-                print "Nearest neighbor ratio:",res[res_argmin]/res[0]
-        else:
-            if VERBOSE > 2:
+
+        kept.append(i)
+        querypatches.append((querypatch-q_mean)/q_std)
+        sizes.append(qkp['size']*KEYPOINT_SCALE)
+        centers.append((x_tkp, y_tkp))
+        tstats.append((t_mean, t_std))
+
+    return matches[kept], querypatches, sizes, centers, tstats
+
+
+def scaleResiduals(trainImg, querypatches, sizes, centers, tstats, scales, method='L2sq', pool=None):
+    """
+    Score every query patch against the train image at every scale in a
+    single vectorized pass.
+
+    This is the per-scale search batched: at each scale the train window
+    sizes*scale wide around the train keypoint is cut out of the train patch
+    at the largest scale, normalized by that patch's (mean,std) in tstats,
+    and the query patch is resized onto the window with cv2.resize. The
+    windows of all keypoints and scales are laid out back to back in one
+    stack, which is scored in a single pass. scales is either a
+    1D array shared by all keypoints or an array of shape (nkeypoints,
+    nscales). Residuals are normalized over scale as in the per-scale
+    search and are nan where the window is empty. If pool is a ResidualPool,
+    the keypoints are scored by its worker processes.
+    """
+    if pool is not None and len(querypatches):
+        return pool.scaleResiduals(trainImg, querypatches, sizes, centers, tstats, scales, method)
+    if method not in ('corr','L1','L2','L2sq'):
+        raise ValueError("Unknown template matching method %r" % method)
+
+    n = len(querypatches)
+    scales = np.asarray(scales, dtype=np.float64)
+    if scales.ndim == 1: scales = np.tile(scales, (n,1))
+    res = np.empty(scales.shape)
+    if not n: return res
+
+    sizes = np.asarray(sizes, dtype=np.float64).reshape(-1)
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1,2)
+    tstats = np.asarray(tstats, dtype=np.float64).reshape(-1,2)
+
+    # bound the size of the sample stack
+    nsamples = np.cumsum(np.sum((sizes.reshape(-1,1)*scales+1)**2, axis=1))
+    start = 0
+    while start < n:
+        offset = nsamples[start-1] if start else 0
+        stop = max(np.searchsorted(nsamples, offset+MAX_BATCH_SAMPLES, 'right'), start+1)
+        res[start:stop] = _scaleResidualsBatch(trainImg, querypatches[start:stop], sizes[start:stop]
+                                               , centers[start:stop], tstats[start:stop], scales[start:stop]
+                                               , method)
+        start = stop
+
+    return res
+
+
+def _scaleResidualsBatch(img, querypatches, sizes, centers, tstats, scales, method):
+    n, S = scales.shape
+    h, w = img.shape[:2]
+
+    # the train patch at the largest scale as cut out by extractPatches
+    rmax = sizes*scalerange[-1] // 2
+    X0 = np.clip(centers[:,0]-rmax, 0, w).astype(int)
+    Y0 = np.clip(centers[:,1]-rmax, 0, h).astype(int)
+    W = np.clip(centers[:,0]+rmax, 0, w).astype(int) - X0
+    H = np.clip(centers[:,1]+rmax, 0, h).astype(int) - Y0
+
+    # the window at every scale within it
+    r = sizes.reshape(-1,1)*scales // 2
+    xt, yt = (centers[:,0]-X0).reshape(-1,1), (centers[:,1]-Y0).reshape(-1,1)
+    wx0 = np.clip(xt-r, 0, W.reshape(-1,1)).astype(int)
+    wy0 = np.clip(yt-r, 0, H.reshape(-1,1)).astype(int)
+    ww = np.clip(xt+r, 0, W.reshape(-1,1)).astype(int) - wx0
+    wh = np.clip(yt+r, 0, H.reshape(-1,1)).astype(int) - wy0
+    npix = (ww*wh).ravel()
+    offsets = np.cumsum(npix) - npix
+
+    # stack the query patch resized onto each window and the window itself
+    # back to back, the resize is cv2's so the stack is that of the
+    # per-scale search
+    Q = np.empty(npix.sum())
+    T = np.empty(npix.sum())
+    geometry = zip(offsets.tolist(), wx0.ravel().tolist(), wy0.ravel().tolist()
+                   , ww.ravel().tolist(), wh.ravel().tolist())
+    for k,q in enumerate(querypatches):
+        q = q.astype(np.float64, copy=False) # cv2 only writes into a dst of its type
+        trainpatch = (img[Y0[k]:Y0[k]+H[k], X0[k]:X0[k]+W[k]] - tstats[k,0]) / tstats[k,1]
+        for o,x,y,sw,sh in geometry[k*S:(k+1)*S]:
+            if not sw*sh: continue
+            cv2.resize(q, (sw,sh), dst=Q[o:o+sw*sh].reshape(sh,sw), interpolation=cv2.INTER_LINEAR)
+            T[o:o+sw*sh].reshape(sh,sw)[:] = trainpatch[y:y+sh, x:x+sw]
+
+    # and score the whole stack at once
+    if method == 'corr':
+        err = np.multiply(Q, T, out=T)
+    elif method == 'L1':
+        err = np.abs(np.subtract(Q, T, out=T), out=T)
+    else:
+        err = np.square(np.subtract(Q, T, out=T), out=T)
+
+    res = np.full(n*S, np.nan)
+    scored = npix > 0
+    if scored.any(): res[scored] = np.add.reduceat(err, offsets[scored])
+    res = res.reshape(n,S)
+    if method == 'L2': res = np.sqrt(res)
+    return res / scales**2 # normalize over scale
+
+
+# shared memory of the ResidualPool worker process
+_shared = {}
+
+def _initPoolWorker(imgbuf, patchbuf):
+    # the pool already runs one worker per core
+    cv2.setNumThreads(1)
+    _shared['img'] = np.frombuffer(imgbuf, np.float32)
+    _shared['patches'] = np.frombuffer(patchbuf, np.float32)
+
+def _poolResiduals(args):
+    imgshape, offsets, shapes, sizes, centers, tstats, scales, method = args
+    img = _shared['img'][:imgshape[0]*imgshape[1]].reshape(imgshape)
+    querypatches = [_shared['patches'][o:o+h*w].reshape(h,w) for o,(h,w) in zip(offsets,shapes)]
+    return scaleResiduals(img, querypatches, sizes, centers, tstats, scales, method)
+
+
+class ResidualPool(object):
+    '''
+    ResidualPool
+
+    A persistent pool of worker processes that scores keypoints with
+    scaleResiduals in parallel. The train image and the query patches are
+    passed through shared memory, only their geometry is pickled, and the
+    keypoints are split into one chunk of about equal work per worker.
+
+    Images larger than imgshape or patches beyond POOL_PATCH_CAPACITY
+    samples are scored in the calling process.
+    '''
+    def __init__(self, imgshape, nworkers=None):
+        self.nworkers = nworkers or mp.cpu_count()
+        self._imgbuf = RawArray(ctypes.c_float, int(np.prod(imgshape)))
+        self._patchbuf = RawArray(ctypes.c_float, POOL_PATCH_CAPACITY)
+        self._img = np.frombuffer(self._imgbuf, np.float32)
+        self._patches = np.frombuffer(self._patchbuf, np.float32)
+        self._lastImg = None
+        self.pool = mp.Pool(self.nworkers, _initPoolWorker, (self._imgbuf, self._patchbuf))
+
+    def scaleResiduals(self, trainImg, querypatches, sizes, centers, tstats, scales, method='L2sq'):
+        n = len(querypatches)
+        nsamples = np.array([q.size for q in querypatches])
+        if trainImg.size > self._img.size or nsamples.sum() > POOL_PATCH_CAPACITY or n < 2:
+            return scaleResiduals(trainImg, querypatches, sizes, centers, tstats, scales, method)
+
+        # the train image is shared by all calls for the same frame
+        if trainImg is not self._lastImg:
+            self._img[:trainImg.size] = trainImg.ravel()
+            self._lastImg = trainImg
+        offsets = np.r_[0, np.cumsum(nsamples)[:-1]]
+        for o,q in zip(offsets,querypatches): self._patches[o:o+q.size] = q.ravel()
+
+        sizes, centers, tstats, scales = map(np.asarray, (sizes, centers, tstats, scales))
+        shapes = [q.shape for q in querypatches]
+
+        # split the keypoints into chunks of about equal sample counts
+        work = np.cumsum(nsamples)
+        bounds = np.searchsorted(work, work[-1]*np.arange(1,self.nworkers)/float(self.nworkers))
+        bounds = np.unique(np.r_[0, bounds, n])
+        tasks = []
+        for i,j in zip(bounds[:-1],bounds[1:]):
+            tasks.append((trainImg.shape, offsets[i:j], shapes[i:j], sizes[i:j], centers[i:j], tstats[i:j]
+                          , scales[i:j] if scales.ndim > 1 else scales, method))
+
+        return np.concatenate(self.pool.map_async(_poolResiduals, tasks).get(POOL_TIMEOUT))
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+def coarseToFineResiduals(trainImg, querypatches, sizes, centers, tstats, method='L2sq', pool=None):
+    """
+    Search scalerange coarse to fine: evaluate every COARSE_STEP'th scale,
+    then repeatedly halve the step and evaluate the neighbors of the best
+    scale found so far.
+
+    Returns the residual table over scalerange (nan where a scale was not
+    evaluated) and the mask of evaluated scales.
+    """
+    n, S = len(querypatches), len(scalerange)
+    sizes, centers, tstats = map(np.asarray, (sizes, centers, tstats))
+    res = np.full((n,S), np.nan)
+    evaluated = np.zeros((n,S), np.bool_)
+    rows = np.arange(n).reshape(-1,1)
+
+    # the unit scale is always evaluated as the reference for the ratio test
+    idx = np.union1d(np.arange(0,S,COARSE_STEP), [S-1])
+    res[:,idx] = scaleResiduals(trainImg, querypatches, sizes, centers, tstats, scalerange[idx], method, pool)
+    evaluated[:,idx] = True
+
+    step = COARSE_STEP
+    while step > 1:
+        step //= 2
+        best = np.where(np.isnan(res), np.inf, res).argmin(axis=1)
+        idx = np.clip(best.reshape(-1,1) + [-step, step], 0, S-1)
+        todo = np.flatnonzero(~evaluated[rows,idx].all(axis=1))
+        if not todo.size: continue
+
+        idx = idx[todo]
+        res[todo.reshape(-1,1),idx] = scaleResiduals(trainImg, [querypatches[i] for i in todo]
+                                                     , sizes[todo], centers[todo], tstats[todo]
+                                                     , scalerange[idx], method, pool)
+        evaluated[todo.reshape(-1,1),idx] = True
+
+    return res, evaluated
+
+
+def refineScale(res, idx):
+    """
+    Fit a parabola through the residuals around the minimum at scalerange[idx]
+    to get the scale at sub-step precision.
+    """
+    scale = scalerange[idx].astype(np.float64)
+    inner = np.flatnonzero((idx > 0) & (idx < len(scalerange)-1))
+    r0, r1, r2 = (res[inner,idx[inner]+k] for k in (-1,0,1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        curv = r0 - 2*r1 + r2
+        delta = np.clip(0.5*(r0-r2)/curv, -0.5, 0.5)
+        fit = np.isfinite(delta) & (curv > 0)
+    scale[inner[fit]] += delta[fit]*(scalerange[1]-scalerange[0])
+
+    return scale
+
+
+def predictScaleWindows(frmbuf, queryKPs, kphist):
+    """
+    Predict the scale of every keypoint that belongs to a mature track of the
+    TrackStore kphist from its last scale estimate, assuming a constant rate
+    of expansion.
+
+    Returns the indices of the predicted keypoints and, for each of them, the
+    indices into scalerange of the unit scale followed by a window of
+    2*TRACK_WINDOW+1 scales around the prediction.
+    """
+    S = len(scalerange)
+    rows = kphist.find(queryKPs['class_id'])
+    tracked = np.flatnonzero(rows >= 0)
+    tr = kphist.tracks[rows[tracked]]
+    mature = (tr['detects'] >= MIN_TRACK_DETECTS) & (tr['nhist'] > 0)
+    tracked, tr = tracked[mature], tr[mature]
+
+    # rate of expansion over the track's last scale estimate
+    t0, t1 = tr['timehist'][np.arange(len(tr)),tr['head']].T
+    t_curr = stampValue(frmbuf.grab(0)[1])
+    t_last = dict((i, stampValue(frmbuf.grab(i)[1])) for i in np.unique(tr['lastFrameIdx']))
+    dt = t_curr - np.array([t_last[i] for i in tr['lastFrameIdx']], np.float64)
+    ok = (t1 > t0) & (dt > 0)
+    tracked, tr, t0, t1, dt = tracked[ok], tr[ok], t0[ok], t1[ok], dt[ok]
+    scale = tr['scalehist'][np.arange(len(tr)),tr['head']]
+    predicted = np.exp(np.log(scale)*dt/(t1-t0))
+
+    center = np.round((predicted-1)*2*SEARCH_RES).astype(np.intp)
+    lo = np.minimum(np.maximum(center-TRACK_WINDOW, 1), S-1-2*TRACK_WINDOW)
+    windows = np.c_[np.zeros(len(lo), np.intp), lo.reshape(-1,1) + np.arange(2*TRACK_WINDOW+1)]
+
+    return tracked.astype(np.intp), windows.reshape(len(tracked), 2*TRACK_WINDOW+2)
+
+
+def _printMatchInfo(qkp, kphist, scales, res, patchshape, scalemin, ratio):
+    print "class_id:",qkp['class_id']
+    print "scale_range =", repr(scales)[6:-1]
+    print "residuals =", repr(res)[6:-1]
+    print "Number of previous detects:", kphist.get([qkp['class_id']], 'detects')[0]
+    print "Frames since last detect:", abs(kphist.get([qkp['class_id']], 'lastFrameIdx', -1)[0])
+    print "Template size =", patchshape
+    print "Relative scaling of template:",scalemin
+    print "Nearest neighbor ratio:",ratio
+
+
+def estimateKeypointExpansion(frmbuf, matches, queryKPs, trainKPs, kphist, method='L2sq'
+                              , search='exhaustive', predict=False, nevals=None, windowHits=None, pool=None):
+    """
+    Estimate the relative scale of every match by template matching over
+    scalerange and return the matches that are expanding with their scales.
+    queryKPs and trainKPs are KEYPOINT_DTYPE arrays, matches a MATCH_DTYPE
+    array.
+
+    search is either 'exhaustive', which evaluates every scale in
+    scalerange, or 'coarse', which searches coarse to fine and refines the
+    best scale to sub-step precision. If predict is set, mature tracks in
+    kphist are first searched only in a window around their predicted scale
+    and fall back to the full search if the window has no acceptable
+    minimum. If nevals is a list, it is extended with the number of scales
+    evaluated for each match that was scored, and if windowHits is a list,
+    with whether each predicted window was accepted. If pool is a ResidualPool,
+    template matching is spread over its worker processes.
+    """
+    if search not in ('exhaustive','coarse'):
+        raise ValueError("Unknown scale search %r" % search)
+
+    matches, querypatches, sizes, centers, tstats = extractPatches(frmbuf, matches, queryKPs, trainKPs, kphist)
+    if not len(matches): return matches, np.empty(0)
+
+    trainImg = frmbuf.grab(0)[0]
+    sizes, centers, tstats = map(np.asarray, (sizes, centers, tstats))
+    n, S = len(matches), len(scalerange)
+    res = np.full((n,S), np.nan)
+    evaluated = np.zeros((n,S), np.bool_)
+    todo = np.arange(n)
+
+    # search mature tracks around their predicted scale first
+    if predict:
+        rows, windows = predictScaleWindows(frmbuf, queryKPs[matches['queryIdx']], kphist)
+        if rows.size:
+            wres = scaleResiduals(trainImg, [querypatches[i] for i in rows], sizes[rows]
+                                  , centers[rows], tstats[rows], scalerange[windows], method, pool)
+            res[rows.reshape(-1,1),windows] = wres
+            evaluated[rows.reshape(-1,1),windows] = True
+
+            # the window minimum must pass the residual check and must not
+            # sit on the window's edge
+            best = np.where(np.isnan(wres[:,1:]), np.inf, wres[:,1:]).argmin(axis=1) + 1
+            bestidx = windows[np.arange(len(rows)),best]
+            onedge = ((best == 1) & (bestidx > 1)) | ((best == windows.shape[1]-1) & (bestidx < S-1))
+            with np.errstate(invalid='ignore'):
+                ok = (wres[np.arange(len(rows)),best] < 0.8*wres[:,0]) & ~onedge
+            todo = np.setdiff1d(todo, rows[ok])
+            if windowHits is not None: windowHits.extend(ok)
+
+    if todo.size and search == 'exhaustive':
+        res[todo] = scaleResiduals(trainImg, [querypatches[i] for i in todo], sizes[todo]
+                                   , centers[todo], tstats[todo], scalerange, method, pool)
+        evaluated[todo] = True
+    elif todo.size and search == 'coarse':
+        cres, cevaluated = coarseToFineResiduals(trainImg, [querypatches[i] for i in todo]
+                                                 , sizes[todo], centers[todo], tstats[todo], method, pool)
+        # keep the residuals of the predicted window the search skipped
+        res[todo] = np.where(cevaluated, cres, res[todo])
+        evaluated[todo] |= cevaluated
+    if nevals is not None: nevals.extend(evaluated.sum(axis=1))
+
+    # determine if the min match is acceptable
+    found = ~np.all(np.isnan(res), axis=1)
+    res_argmin = np.where(np.isnan(res), np.inf, res).argmin(axis=1)
+    res_min = res[np.arange(len(res)), res_argmin]
+    scalemin = scalerange[res_argmin] if search == 'exhaustive' else refineScale(res, res_argmin)
+    with np.errstate(invalid='ignore'):
+        accept = found & (scalemin > MINSIZE) & (res_min < 0.8*res[:,0])
+
+    if VERBOSE > 1:
+        for i,m in enumerate(matches):
+            if accept[i] or (found[i] and VERBOSE > 2):
                 print
-                print "could not match feature"
-                print "class_id:",qkp.class_id
-                print "scale_range =", repr(scalerange)[6:-1]
-                # print "residuals =", repr((res-np.nanmin(res))/(np.nanmax(res)-np.nanmin(res)))[6:-1]
-                print "residuals =", repr(res)[6:-1]
-                print "Number of previous detects:", kphist[qkp.class_id].detects if qkp.class_id in kphist else 0
-                # print "Number of previous scale estimates:", len(kphist[qkp.class_id].scalehist) if qkp.class_id in kphist else 1
-                print "Frames since last detect:", abs(kphist[qkp.class_id].lastFrameIdx) if qkp.class_id in kphist else 1
-                # print "Frames since first detect:", kphist[qkp.class_id].age+1 if qkp.class_id in kphist else 1
-                print "Template size =", querypatch.shape
-                print "Relative scaling of template:",scalemin
-                print "Nearest neighbor ratio:",res[res_argmin]/res[0]
-        # scale_argmin.append(scalemin)
-        # expandingMatches.append(m)
-
-    return expandingMatches, scale_argmin
+                if not accept[i]: print "could not match feature"
+                _printMatchInfo(queryKPs[m['queryIdx']], kphist, scalerange, res[i]
+                                , querypatches[i].shape, scalemin[i], res_min[i]/res[i,0])
+
+    return matches[accept], scalemin[accept]
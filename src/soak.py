@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+'''
+Soak test of the tracker: track a synthetic expanding scene for a long
+simulated session and check that memory stays flat.
+
+    python soak.py --minutes 60 -o soak.json
+'''
+import argparse
+import json
+import resource
+import sys
+import time
+
+import numpy as np
+
+from common import HISTORY_DEPTH
+from framebuffer import FrameHistory
+from features import FeatureEngine, ENGINES, DEFAULT_ENGINE
+from matching import DescriptorMatcher, MATCHERS
+from synthetic import ExpandingScene, FPS
+from tracking import ExpansionTracker, LAST_DAY
+
+WARMUP = 0.1 # fraction of the samples taken before the memory baseline
+MAX_GROWTH = 16. # MB the resident size may grow by after the warmup
+
+
+def residentMB():
+    # current resident size where /proc is available, peak size otherwise
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*resource.getpagesize()/2.**20
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2.**10
+
+
+def sample(tracker, frameIdx, t0):
+    store = tracker.kpHist
+    nbytes = store.tracks.nbytes + (store.descriptors.nbytes if len(store) else 0)
+    return dict(frame=frameIdx, elapsed=time.time()-t0, rss_mb=residentMB()
+                , tracks=len(store), store_kb=nbytes/1024., carried=len(tracker.queryKP)
+                , max_scales=int(store.tracks['nhist'].max()) if len(store) else 0
+                , max_detects=int(store.tracks['detects'].max()) if len(store) else 0)
+
+
+def soak(scene, nframes, tracker, history, every):
+    '''
+    Track nframes frames of scene, sampling memory use every every frames.
+    '''
+    t0 = time.time()
+    frame = scene.frame(0)
+    history.push(frame, scene.time(0))
+    tracker.reset(frame, scene.time(0))
+
+    samples = []
+    for i in range(1, nframes):
+        frame = scene.frame(i)
+        t = scene.time(i)
+        history.push(frame, t)
+
+        trainKP, tdesc = tracker.detect(frame)
+        matches = tracker.match(trainKP, tdesc)
+        matches, kpscales = tracker.estimateExpansion(matches)
+        tracker.update(matches, kpscales, t)
+
+        if i % every == 0 or i == nframes-1:
+            samples.append(sample(tracker, i, t0))
+            s = samples[-1]
+            print >> sys.stderr, "%6.1f min: %7.1f MB, %4d tracks, %7.1f kB store" \
+                % (i/FPS/60, s['rss_mb'], s['tracks'], s['store_kb'])
+
+    return samples
+
+
+def parseSize(s):
+    h, w = map(int, s.lower().split('x'))
+    return h, w
+
+
+# ==========================================================
+# process options and set up defaults
+# ==========================================================
+parser = argparse.ArgumentParser(usage="soak.py [options]")
+parser.add_argument("--minutes", dest="minutes", type=float, default=60.
+                    , help="Simulated session length in minutes at %g fps. (%%(default)s)" % FPS)
+
+parser.add_argument("--size", dest="size", default="240x320"
+                    , help="Frame size as HxW. (%(default)s)")
+
+parser.add_argument("--patches", dest="patches", type=int, default=4
+                    , help="Number of expanding patches. (%(default)s)")
+
+parser.add_argument("--seed", dest="seed", type=int, default=0
+                    , help="Seed of the synthetic scene. (%(default)s)")
+
+parser.add_argument("--features", dest="features", default=DEFAULT_ENGINE, choices=ENGINES.keys()
+                    , help="Feature detector and descriptor. (%(default)s)")
+
+parser.add_argument("--threshold", dest="threshold", type=float, default=None
+                    , help="Set the detection threshold. (engine default)")
+
+parser.add_argument("--matcher", dest="matcher", default="bf", choices=MATCHERS
+                    , help="Descriptor matcher. (%(default)s)")
+
+parser.add_argument("--history-depth", dest="historydepth", type=int, default=HISTORY_DEPTH
+                    , help="Scale estimates kept per keypoint track. (%(default)s)")
+
+parser.add_argument("--sample-period", dest="sampleperiod", type=float, default=60.
+                    , help="Simulated seconds between memory samples. (%(default)s)")
+
+parser.add_argument("--max-growth", dest="maxgrowth", type=float, default=MAX_GROWTH
+                    , help="MB the resident size may grow by after the warmup. (%(default)s)")
+
+parser.add_argument("-o", "--output", dest="output", default=None
+                    , help="Write the JSON report to this file instead of stdout.")
+
+opts = parser.parse_args()
+if opts.matcher == 'lsh' and not ENGINES[opts.features].binary:
+    parser.error("LSH matching requires binary descriptors, %s descriptors are floating point" % opts.features.upper())
+if opts.matcher == 'kdtree' and ENGINES[opts.features].binary:
+    parser.error("KD-tree matching requires floating point descriptors, %s descriptors are binary" % opts.features.upper())
+
+shape = parseSize(opts.size)
+h, w = shape
+nframes = int(opts.minutes*60*FPS)
+every = max(1, int(opts.sampleperiod*FPS))
+
+roi = np.zeros(shape, np.uint8)
+roi[h//4:-(h//4), w//4:-(w//4)] = True
+scene = ExpandingScene(shape, opts.patches, seed=opts.seed, region=(w//4, h//4, w-w//4, h-h//4))
+history = FrameHistory(historysize=LAST_DAY+1)
+detector = FeatureEngine(opts.features, opts.threshold)
+matcher = DescriptorMatcher(opts.matcher, binary=detector.binary)
+tracker = ExpansionTracker(detector, matcher, roi, history, 'L2', depth=opts.historydepth
+                           , ratio=detector.ratio, maxdist=detector.maxdist)
+
+samples = soak(scene, nframes, tracker, history, every)
+
+# memory is flat if it does not grow past the baseline taken after the warmup
+baseline = samples[min(int(WARMUP*len(samples)), len(samples)-1)]['rss_mb']
+growth = max(s['rss_mb'] for s in samples) - baseline
+report = dict(options=vars(opts), frames=nframes, baseline_mb=baseline, growth_mb=growth
+              , peak_tracks=max(s['tracks'] for s in samples), samples=samples
+              , passed=bool(growth <= opts.maxgrowth))
+
+if opts.output:
+    with open(opts.output, 'w') as f: json.dump(report, f, indent=2, sort_keys=True)
+else:
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print
+
+sys.exit(0 if report['passed'] else 1)
@@ -0,0 +1,88 @@
+import cv2
+import numpy as np
+
+FPS = 10.
+
+
+def texture(shape, rng, sigma=2.):
+    # smoothed noise stretched to the full intensity range
+    tex = cv2.GaussianBlur(rng.rand(*shape).astype(np.float32), (0,0), sigma)
+    return cv2.normalize(tex, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+
+class ExpandingScene(object):
+    '''
+    ExpandingScene
+
+    A deterministic synthetic sequence of textured square patches over a
+    faint static background. Every patch expands about its center by its own
+    rate per frame for period frames, then starts over at its base size, so
+    the true relative scale of a patch between any two frames is known.
+
+    Patch rates are drawn uniformly from the range rates, or all equal
+    rates[0] if a single rate is given. Patch centers are drawn within
+    region (x0,y0,x1,y1), the whole frame by default. Frames are timestamped
+    in ms at FPS frames per second, like the frames of a VideoBuffer.
+    '''
+    def __init__(self, shape=(240,320), npatches=4, rates=(1.25,1.35), period=3, patchsize=32, seed=0
+                 , region=None):
+        rng = np.random.RandomState(seed)
+        self.shape = tuple(shape)
+        self.period = period
+        self.background = (texture(self.shape, rng, 4.)//8 + 112).astype(np.uint8)
+
+        # patches are placed where they stay in the frame at their largest
+        maxhalf = patchsize*max(rates)**(period-1)/2.
+        h, w = self.shape
+        x0, y0, x1, y1 = region if region is not None else (0, 0, w, h)
+        self.patches = []
+        for i in range(npatches):
+            center = (rng.uniform(max(x0,maxhalf), min(x1,w-maxhalf))
+                      , rng.uniform(max(y0,maxhalf), min(y1,h-maxhalf)))
+            rate = rng.uniform(*rates) if len(rates) == 2 else rates[0]
+            tex = texture((2*int(maxhalf)+2,)*2, rng)
+            self.patches.append((center, rate, patchsize/2., tex))
+
+    def patchScale(self, p, frameIdx):
+        return self.patches[p][1]**(frameIdx % self.period)
+
+    def frame(self, frameIdx):
+        img = self.background.copy()
+        h, w = self.shape
+        for p,(center, rate, half, tex) in enumerate(self.patches):
+            s = self.patchScale(p, frameIdx)
+            # map the texture's center onto the patch center, scaled by s
+            tc = (tex.shape[1]-1)/2.
+            M = np.float32([[s, 0, center[0]-s*tc], [0, s, center[1]-s*tc]])
+            warped = cv2.warpAffine(tex, M, (w,h), flags=cv2.INTER_LINEAR)
+            r = half*s
+            x0, x1 = int(round(center[0]-r)), int(round(center[0]+r))
+            y0, y1 = int(round(center[1]-r)), int(round(center[1]+r))
+            img[y0:y1, x0:x1] = warped[y0:y1, x0:x1]
+        return img
+
+    def time(self, frameIdx):
+        return frameIdx*1000./FPS
+
+    def frameIndex(self, t):
+        return int(round(t*FPS/1000.))
+
+    def patchAt(self, pt, frameIdx):
+        '''
+        Index of the top most patch covering pt in frame frameIdx, or None if
+        pt lies on the background.
+        '''
+        for p in reversed(range(len(self.patches))):
+            center, rate, half, tex = self.patches[p]
+            r = half*self.patchScale(p, frameIdx)
+            if abs(pt[0]-center[0]) < r and abs(pt[1]-center[1]) < r: return p
+        return None
+
+    def trueScale(self, pt, frameA, frameB):
+        '''
+        True relative scale between frames frameA and frameB of the scene at
+        pt in frameB. The static background has unit scale.
+        '''
+        p = self.patchAt(pt, frameB)
+        if p is None: return 1.
+        return self.patchScale(p, frameB)/self.patchScale(p, frameA)
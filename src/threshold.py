@@ -0,0 +1,61 @@
+import numpy as np
+
+TARGET_N_KP = 50 # keypoints per frame
+MIN_THRESH = 500
+MAX_THRESH = 10000
+GAIN_P = 0.3
+GAIN_I = 0.05
+MODES = ('keypoints','latency')
+
+
+class ThresholdController(object):
+    '''
+    ThresholdController
+
+    PI controller that adapts the detector's threshold from frame to frame
+    so that either the number of keypoints detected ('keypoints' mode) or
+    the processing time of a frame in ms ('latency' mode) follows target.
+
+    Keypoint counts, and with them processing times, fall off roughly as a
+    power of the threshold, so the controller works on the log of the
+    threshold with the error log(measured/target). The threshold is kept
+    within [lo,hi] and the integral term is frozen while it is held at
+    either bound.
+    '''
+    def __init__(self, detector, target, mode='keypoints', lo=MIN_THRESH, hi=MAX_THRESH
+                 , kp=GAIN_P, ki=GAIN_I, attr='hessianThreshold'):
+        if mode not in MODES:
+            raise ValueError("Unknown threshold control mode %r" % mode)
+        if target <= 0 or not 0 < lo <= hi:
+            raise ValueError("Threshold control needs a positive target and 0 < lo <= hi")
+        self.detector = detector
+        self.target = float(target)
+        self.mode = mode
+        self.lo, self.hi = float(lo), float(hi)
+        self.kp, self.ki = kp, ki
+        self.attr = attr
+        self.error = 0.
+        self._integral = 0.
+        self._base = np.log(np.clip(self.threshold, self.lo, self.hi))
+        self.threshold = np.exp(self._base)
+
+    @property
+    def threshold(self): return getattr(self.detector, self.attr)
+
+    @threshold.setter
+    def threshold(self, value): setattr(self.detector, self.attr, float(value))
+
+    def update(self, nkeypoints, seconds):
+        '''
+        Adapt the threshold to the last frame's keypoint count and processing
+        time in seconds and return the new threshold.
+        '''
+        measured = nkeypoints if self.mode == 'keypoints' else seconds*1000
+        # an empty frame counts as half a keypoint so the error stays finite
+        self.error = np.log(max(measured, 0.5)/self.target)
+        integral = self._integral + self.error
+        u = self._base + self.kp*self.error + self.ki*integral
+
+        if np.log(self.lo) < u < np.log(self.hi): self._integral = integral
+        self.threshold = np.exp(np.clip(u, np.log(self.lo), np.log(self.hi)))
+        return self.threshold
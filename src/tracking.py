@@ -0,0 +1,251 @@
+import cv2
+import numpy as np
+
+from common import *
+import scale_matching as smatch
+from trackstore import TrackStore, DescriptorPool
+
+VERBOSE = 0
+LAST_DAY = 10
+FIRST_ID = 2 # starts at 2 since default class_id for keypoints can be +/-1
+MATCH_RATIO = 0.8 # nearest neighbor ratio test
+MATCH_DISTANCE = 0.25 # max descriptor distance of SURF descriptors
+KLT_WINDOW = (21,21)
+KLT_LEVELS = 3
+KLT_CRITERIA = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03)
+KLT_FB_ERROR = 1. # max forward-backward error in pixels of a keypoint tracked by optical flow
+
+# the expanding keypoints found in the latest frame, with the time step
+# (t0,t1) their scale was estimated over
+EXPANSION_DTYPE = np.dtype([('x',np.float64), ('y',np.float64), ('size',np.float64), ('querySize',np.float64)
+                            , ('class_id',np.int64), ('scale',np.float64), ('detects',np.int32)
+                            , ('t0',np.float64), ('t1',np.float64), ('ttc',np.float64), ('ttc_var',np.float64)])
+
+
+class ExpansionTracker(object):
+    '''
+    ExpansionTracker
+
+    Carries keypoints from frame to frame: the keypoints detected in each new
+    frame are matched to the last frame's, the expansion of the matches is
+    estimated and the history of expanding keypoints is kept in the
+    TrackStore kpHist.
+
+    frmbuf is the buffer holding the frames that keypoints were detected
+    in, with frmbuf.grab(0) the frame being tracked. If pool is a
+    scale_matching.ResidualPool, expansion is estimated in its worker
+    processes. depth is the number of scale estimates kept per track. Matches
+    are kept if their nearest neighbor distance ratio is below ratio and
+    their descriptor distance below maxdist, both of which depend on the
+    detector's descriptors. timeunit is the length in seconds of the frame
+    times' unit (ms for video files), so that the smoothed time to contact
+    of every track comes out in seconds.
+
+    If redetect is more than 1, keypoints are detected and matched only
+    every redetect frames, or whenever fewer than minTracks keypoints are
+    carried over, and are tracked by optical flow in between (see
+    needsDetection and flow).
+    '''
+    def __init__(self, detector, matcher, roi, frmbuf, method='L2', search='exhaustive', predict=False, pool=None
+                 , depth=HISTORY_DEPTH, ratio=MATCH_RATIO, maxdist=MATCH_DISTANCE, redetect=1, minTracks=0
+                 , timeunit=1e-3):
+        self.detector = detector
+        self.matcher = matcher
+        self.roi = roi
+        self.frmbuf = frmbuf
+        self.method = method
+        self.search = search
+        self.predict = predict
+        self.pool = pool
+        self.ratio = ratio
+        self.maxdist = maxdist
+        self.redetect = redetect
+        self.minTracks = minTracks
+        self.flowing = False
+        self._sinceDetect = 0
+        self.kpHist = TrackStore(depth, timeunit=timeunit)
+        self.carried = DescriptorPool()
+        self.queryKP, self.qdesc = np.empty(0, KEYPOINT_DTYPE), None
+        self.trainKP, self.tdesc = np.empty(0, KEYPOINT_DTYPE), None
+        self.t_last = None
+        self.nevals, self.windowHits = [], []
+        self._nextid = FIRST_ID
+
+    def reset(self, frame, t, features=None):
+        '''
+        Forget all history and start tracking from the keypoints in frame,
+        given as the (keypoints, descriptors) pair features if they are
+        already detected.
+        '''
+        self.kpHist.clear()
+        self._nextid = FIRST_ID
+        self.queryKP, self.qdesc = self.detect(frame) if features is None else features
+        self.queryKP['class_id'] = self._newIds(len(self.queryKP))
+        self.t_last = t
+        self._sinceDetect = 0
+
+    def _newIds(self, n):
+        ids = np.arange(self._nextid, self._nextid+n)
+        self._nextid += n
+        return ids
+
+    def detect(self, frame):
+        '''
+        Detect keypoints in frame, returned as a KEYPOINT_DTYPE array, and
+        their descriptors.
+        '''
+        keypoints, descriptors = self.detector.detectAndCompute(frame, self.roi)
+        return toKeypointArray(keypoints), descriptors
+
+    def needsDetection(self):
+        '''
+        Whether keypoints must be detected in the next frame, rather than
+        tracked into it by optical flow.
+        '''
+        return self._sinceDetect+1 >= self.redetect or len(self.queryKP) < self.minTracks
+
+    def match(self, trainKP, tdesc):
+        '''
+        Match the keypoints of the new frame to the last frame's keypoints and
+        filter out poor matches. Matched keypoints take over the ID of the
+        keypoint they were matched to. If trainKP is None, the last frame's
+        keypoints are tracked into the new frame by optical flow instead.
+
+        Returns the matches as a MATCH_DTYPE array.
+        '''
+        # First, assign _every_ query keypoint a unique ID
+        # Note: 1 and -1 are the openCV default class_ids
+        queryKP = self.queryKP
+        unassigned = np.in1d(queryKP['class_id'], (1,-1))
+        queryKP['class_id'][unassigned] = self._newIds(np.count_nonzero(unassigned))
+
+        self.flowing = trainKP is None
+        if self.flowing:
+            self._sinceDetect += 1
+            return self.flow()
+        self._sinceDetect = 0
+
+        self.trainKP, self.tdesc = trainKP, tdesc
+
+        # Find the best K matches for each keypoint
+        queryIdx, trainIdx, distance = self.matcher.knnMatch(self.qdesc,tdesc,k=2
+                                                             , queryPts=np.c_[queryKP['x'],queryKP['y']]
+                                                             , trainPts=np.c_[trainKP['x'],trainKP['y']])
+        if VERBOSE > 2:
+            print "Match time: %6.2f ms" % (self.matcher.matchTime*1000),
+            if self.matcher.recall is not None: print "(recall %.3f)" % self.matcher.recall,
+            print
+
+        # Filter out poor matches by ratio test , maximum (descriptor) distance
+        good = distance[:,0] < self.maxdist
+        if distance.shape[1] > 1: good &= distance[:,0] < self.ratio*distance[:,1]
+        matches = matchArray(queryIdx[good], trainIdx[good,0], distance[good,0])
+        queryIdx, trainIdx = matches['queryIdx'], matches['trainIdx']
+        trainKP['class_id'][trainIdx] = queryKP['class_id'][queryIdx]  # carry over the key point's ID
+        matchdist = diffKP_L2(queryKP[queryIdx],trainKP[trainIdx])      # get the match pixel distance
+
+        if len(matches):    # Filter out matches with outlier spatial distances
+            # mean of the distances with the largest quarter cut off
+            keep = len(matchdist) - int(0.25*len(matchdist))
+            threshdist = np.mean(np.partition(matchdist, keep-1)[:keep]) + 2*np.std(matchdist)
+            matches = matches[matchdist < threshdist]
+
+        return matches
+
+    def flow(self):
+        '''
+        Track the last frame's keypoints into frmbuf.grab(0) with pyramidal
+        Lucas-Kanade optical flow. Keypoints that fail the forward-backward
+        check or leave the ROI are dropped; the rest keep their ID, size and
+        descriptor and become the new frame's keypoints. Returns their
+        matches to the last frame's keypoints.
+        '''
+        queryKP = self.queryKP
+        prevImg, currImg = self.frmbuf.grab(-1)[0], self.frmbuf.grab(0)[0]
+        tracked = np.empty(0, np.intp)
+        if len(queryKP) and prevImg.size:
+            p0 = np.c_[queryKP['x'],queryKP['y']].astype(np.float32).reshape(-1,1,2)
+            p1, st, _ = cv2.calcOpticalFlowPyrLK(prevImg, currImg, p0, None, winSize=KLT_WINDOW
+                                                 , maxLevel=KLT_LEVELS, criteria=KLT_CRITERIA)
+            p0r, st_r, _ = cv2.calcOpticalFlowPyrLK(currImg, prevImg, p1, None, winSize=KLT_WINDOW
+                                                    , maxLevel=KLT_LEVELS, criteria=KLT_CRITERIA)
+            p1 = p1.reshape(-1,2)
+            fberr = np.sqrt(np.sum((p0-p0r).reshape(-1,2)**2, axis=1))
+            xi, yi = np.round(p1).astype(np.intp).T
+            h, w = self.roi.shape[:2]
+            ok = (st.ravel() > 0) & (st_r.ravel() > 0) & (fberr < KLT_FB_ERROR) & (xi >= 0) & (xi < w) & (yi >= 0) & (yi < h)
+            ok[ok] = self.roi[yi[ok], xi[ok]] > 0
+            tracked = np.flatnonzero(ok)
+
+        trainKP = queryKP[tracked]
+        if len(tracked): trainKP['x'], trainKP['y'] = p1[tracked].T
+        self.trainKP = trainKP
+        self.tdesc = self.qdesc[tracked] if self.qdesc is not None else None
+
+        return matchArray(tracked, np.arange(len(tracked)))
+
+    def estimateExpansion(self, matches):
+        '''
+        Find an estimate of the scale change for matches that are expanding.
+        Keypoints tracked by optical flow keep their last detected size, so
+        on flow frames only the tracks that were expanding in the last frame
+        are searched. Returns the expanding matches and an array of their
+        scales.
+        '''
+        if self.flowing:
+            recent = self.kpHist.get(self.queryKP['class_id'][matches['queryIdx']], 'age', LAST_DAY) == 0
+            matches = matches[recent]
+        else:
+            trainSize, querySize = self.trainKP['size'], self.queryKP['size']
+            matches = matches[trainSize[matches['trainIdx']] > querySize[matches['queryIdx']]]
+        self.nevals, self.windowHits = [], []
+        matches, kpscales = smatch.estimateKeypointExpansion(self.frmbuf, matches, self.queryKP, self.trainKP
+                                                             , self.kpHist, self.method, search=self.search
+                                                             , predict=self.predict, nevals=self.nevals
+                                                             , windowHits=self.windowHits, pool=self.pool)
+        if VERBOSE > 2 and self.nevals: print "Scales evaluated per keypoint: %.1f" % np.mean(self.nevals)
+        if VERBOSE > 2 and self.windowHits:
+            print "Predicted windows accepted: %d/%d" % (sum(self.windowHits), len(self.windowHits))
+
+        return matches, kpscales
+
+    def update(self, matches, kpscales, t_curr):
+        '''
+        Update the history of expanding keypoints, carry over the keypoints
+        that were missed in this frame and move on to the next frame.
+
+        Returns the expanding matches as an EXPANSION_DTYPE array.
+        '''
+        queryKP, trainKP, tdesc, kpHist = self.queryKP, self.trainKP, self.tdesc, self.kpHist
+
+        # update matched expanding keypoints with accurate scale, latest
+        # keypoint and descriptor
+        queryIdx, trainIdx = matches['queryIdx'], matches['trainIdx']
+        expanding = trainKP[trainIdx]
+        t0 = kpHist.update(expanding['class_id'], expanding, tdesc[trainIdx] if len(trainIdx) else None
+                           , self.t_last, t_curr, kpscales)
+
+        expansions = np.empty(len(expanding), EXPANSION_DTYPE)
+        for field in ('x','y','size','class_id'): expansions[field] = expanding[field]
+        expansions['querySize'] = queryKP['size'][queryIdx]
+        expansions['scale'] = kpscales
+        expansions['detects'] = kpHist.get(expanding['class_id'], 'detects')
+        expansions['t0'] = t0
+        expansions['t1'] = stampValue(t_curr)
+        expansions['ttc'], expansions['ttc_var'] = kpHist.ttc(expanding['class_id'])
+
+        # get rid of old matches
+        kpHist.age(LAST_DAY)
+
+        # keep matches that were missed in this frame, in preallocated rows
+        # after this frame's keypoints. Every missed track brings its own
+        # last descriptor, one row per keypoint (the loop this replaced gave
+        # them all the last updated track's descriptor and appended only
+        # one row, so the rows after it did not line up with the keypoints)
+        missed = kpHist.missedRows(trainKP['class_id'])
+
+        # shift the loop data
+        self.queryKP, self.qdesc = self.carried.fill(trainKP, tdesc, kpHist, missed)
+        self.t_last = t_curr
+
+        return expansions
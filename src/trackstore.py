@@ -0,0 +1,266 @@
+import numpy as np
+
+from common import HISTORY_DEPTH, KEYPOINT_DTYPE, stampValue, filterExpansionRate, ttcFromRate
+
+POOL_CAPACITY = 1024 # rows preallocated for the keypoints carried from frame to frame
+
+
+def trackDtype(depth=HISTORY_DEPTH):
+    return np.dtype([('class_id',np.int64), ('age',np.int32), ('lastFrameIdx',np.int32)
+                     , ('detects',np.int32), ('consecutive',np.int32)
+                     , ('x',np.float64), ('y',np.float64), ('size',np.float64), ('response',np.float64)
+                     , ('scalehist',np.float64,(depth,)), ('timehist',np.float64,(depth,2))
+                     , ('nhist',np.int32), ('head',np.int32), ('rate',np.float64), ('ratevar',np.float64)])
+
+
+class TrackView(object):
+    '''
+    TrackView
+
+    One track of a TrackStore as an object: its age, detects, last keypoint
+    and descriptor, scale and time histories and time to contact. Views
+    refer to the track's row, so they are only valid until tracks are added
+    to or pruned from the store.
+    '''
+    __slots__ = ('_store','_row')
+
+    def __init__(self,store,row):
+        self._store = store
+        self._row = row
+
+    def _field(self,name): return self._store.tracks[name][self._row]
+
+    age = property(lambda self: int(self._field('age')))
+    lastFrameIdx = property(lambda self: int(self._field('lastFrameIdx')))
+    detects = property(lambda self: int(self._field('detects')))
+    consecutive = property(lambda self: int(self._field('consecutive')))
+    keypoint = property(lambda self: self._store.keypoints([self._row])[0])
+    descriptor = property(lambda self: self._store.descriptors[self._row])
+    scalehist = property(lambda self: self._store.history('scalehist',self._row))
+    timehist = property(lambda self: self._store.history('timehist',self._row))
+    ttc = property(lambda self: float(self._store.ttc([self._store.tracks['class_id'][self._row]])[0][0]))
+    ttc_var = property(lambda self: float(self._store.ttc([self._store.tracks['class_id'][self._row]])[1][0]))
+
+
+class TrackStore(object):
+    '''
+    TrackStore
+
+    The history of every expanding keypoint, stored column wise in a NumPy
+    structured array sorted by class_id, with the keypoints' last
+    descriptors in a matching array. The scale and time histories are rings
+    of the last depth updates. Lookup, update, aging and pruning work on all
+    tracks at once. Every track also filters its expansion rate as it is
+    updated, giving a smoothed time to contact; timeunit is the length in
+    seconds of the time stamps' unit (video file times are in ms).
+
+    Supports `class_id in store` and `store[class_id]`, which returns a
+    TrackView.
+    '''
+    def __init__(self,depth=HISTORY_DEPTH,capacity=64,timeunit=1e-3):
+        self.depth = depth
+        self.timeunit = timeunit
+        self._tracks = np.zeros(capacity, trackDtype(depth))
+        self._desc = None
+        self._n = 0
+
+    tracks = property(lambda self: self._tracks[:self._n])
+    descriptors = property(lambda self: self._desc[:self._n])
+
+    def __len__(self): return self._n
+
+    def __contains__(self,class_id): return self.find([class_id])[0] >= 0
+
+    def __getitem__(self,class_id):
+        row = self.find([class_id])[0]
+        if row < 0: raise KeyError(class_id)
+        return TrackView(self,row)
+
+    def __iter__(self): return iter(self.tracks['class_id'].tolist())
+
+    def clear(self):
+        self._n = 0
+
+    def find(self,class_ids):
+        '''
+        Rows of the tracks with the given class_ids, -1 for unknown ones.
+        '''
+        ids = np.asarray(class_ids, np.int64).reshape(-1)
+        if not self._n: return np.full(len(ids), -1, np.intp)
+        known = self.tracks['class_id']
+        rows = np.minimum(np.searchsorted(known, ids), self._n-1)
+        return np.where(known[rows] == ids, rows, -1)
+
+    def get(self,class_ids,field,default=0):
+        '''
+        The field of the tracks with the given class_ids, default for unknown
+        ones.
+        '''
+        rows = self.find(class_ids)
+        values = np.full(len(rows), default, self._tracks.dtype[field])
+        values[rows >= 0] = self.tracks[field][rows[rows >= 0]]
+        return values
+
+    def history(self,field,row):
+        # ring entries of a track from oldest to newest
+        tr = self._tracks[row]
+        idx = (tr['head'] - np.arange(tr['nhist'])[::-1]) % self.depth
+        return tr[field][idx]
+
+    def keypoints(self,rows,out=None):
+        tr = self.tracks
+        keypoints = np.empty(len(rows), KEYPOINT_DTYPE) if out is None else out
+        for field in KEYPOINT_DTYPE.names: np.take(tr[field], rows, out=keypoints[field])
+        return keypoints
+
+    def _reserve(self,n,desc):
+        if n > len(self._tracks):
+            tracks = np.zeros(max(n,2*len(self._tracks)), self._tracks.dtype)
+            tracks[:self._n] = self.tracks
+            self._tracks = tracks
+        if self._desc is None or self._desc.shape[1:] != desc.shape[1:] or self._desc.dtype != desc.dtype:
+            self._desc = np.zeros((len(self._tracks),)+desc.shape[1:], desc.dtype)
+        elif len(self._desc) < len(self._tracks):
+            d = np.zeros((len(self._tracks),)+self._desc.shape[1:], self._desc.dtype)
+            d[:self._n] = self.descriptors
+            self._desc = d
+
+    def _insert(self,class_ids,desc):
+        n, k = self._n, len(class_ids)
+        self._reserve(n+k, desc)
+        self._tracks[n:n+k] = np.zeros(1, self._tracks.dtype)
+        self._tracks['class_id'][n:n+k] = class_ids
+        self._tracks['age'][n:n+k] = -1
+        self._tracks['ratevar'][n:n+k] = np.inf
+        self._n += k
+
+        # new ids are normally larger than all known ones
+        if n and class_ids[0] < self._tracks['class_id'][n-1]:
+            order = np.argsort(self.tracks['class_id'], kind='mergesort')
+            self._tracks[:self._n] = self.tracks[order]
+            self._desc[:self._n] = self.descriptors[order]
+
+    def update(self,class_ids,keypoints,descriptors,t_new,t1,scales):
+        '''
+        Record the latest keypoint (a KEYPOINT_DTYPE array), descriptor and
+        scale of every track in class_ids at time t1, adding tracks for unknown class_ids. A track
+        that is updated more than once keeps the last of its updates.
+
+        Returns the time the scale of every update is relative to: the time
+        of the track's previous update, or t_new for new tracks.
+        '''
+        ids = np.asarray(class_ids, np.int64).reshape(-1)
+        if not len(ids): return np.empty(0)
+        descriptors = np.asarray(descriptors).reshape(len(ids),-1)
+
+        rows = self.find(ids)
+        new = np.unique(ids[rows < 0])
+        if new.size: self._insert(new, descriptors)
+        self._reserve(self._n, descriptors)
+        rows = self.find(ids)
+
+        tr = self._tracks
+        t1 = stampValue(t1)
+        t0 = np.where(tr['nhist'][rows] > 0, tr['timehist'][rows,tr['head'][rows],1], stampValue(t_new))
+
+        # apply the last update of each track
+        _, last = np.unique(ids[::-1], return_index=True)
+        last = len(ids)-1-last
+        r = rows[last]
+        tr['consecutive'][r] = np.where(tr['nhist'][r] > 0, tr['consecutive'][r]+1, 1)
+        tr['age'][r] = -1
+        tr['lastFrameIdx'][r] = 0
+        tr['detects'][r] += 1
+        head = np.where(tr['nhist'][r] > 0, (tr['head'][r]+1) % self.depth, 0)
+        tr['head'][r] = head
+        tr['nhist'][r] = np.minimum(tr['nhist'][r]+1, self.depth)
+        tr['scalehist'][r,head] = np.asarray(scales, np.float64)[last]
+        tr['timehist'][r,head,0] = t0[last]
+        tr['timehist'][r,head,1] = t1
+        tr['rate'][r], tr['ratevar'][r] = filterExpansionRate(tr['rate'][r], tr['ratevar'][r]
+                                                              , tr['scalehist'][r,head], (t1-t0[last])*self.timeunit)
+        for field in ('x','y','size','response'):
+            tr[field][r] = keypoints[field][last]
+        self._desc[r] = descriptors[last]
+
+        return t0
+
+    def ttc(self,class_ids):
+        '''
+        Smoothed time to contact in seconds of the tracks with the given
+        class_ids and its variance, infinite for unknown tracks.
+        '''
+        return ttcFromRate(self.get(class_ids,'rate'), self.get(class_ids,'ratevar',np.inf))
+
+    def age(self,maxage):
+        '''
+        Age every track by one frame and drop the tracks that have not been
+        updated for maxage frames.
+        '''
+        tr = self.tracks
+        tr['age'] += 1
+        tr['lastFrameIdx'] -= 1
+        keep = np.flatnonzero(tr['age'] < maxage)
+        if len(keep) < self._n:
+            self._tracks[:len(keep)] = tr[keep]
+            if self._desc is not None: self._desc[:len(keep)] = self._desc[keep]
+            self._n = len(keep)
+
+    def missedRows(self,detected):
+        '''
+        Rows of the aged tracks whose class_id is not among the detected
+        class_ids.
+        '''
+        tr = self.tracks
+        return np.flatnonzero((tr['age'] > 0) & ~np.in1d(tr['class_id'], np.asarray(detected, np.int64)))
+
+    def missed(self,detected):
+        '''
+        Keypoints and descriptors of the aged tracks whose class_id is not
+        among the detected class_ids.
+        '''
+        rows = self.missedRows(detected)
+        return self.keypoints(rows), (self.descriptors[rows] if len(rows) else None)
+
+
+class DescriptorPool(object):
+    '''
+    DescriptorPool
+
+    Preallocated keypoint and descriptor rows for the keypoints carried from
+    one frame to the next: a frame's own keypoints followed by the missed
+    tracks of a TrackStore, in the order the matcher indexes them. Two sets
+    of rows alternate so that the last frame's keypoints stay valid while
+    the next frame's are filled. Rows are reallocated only when a frame
+    needs more than capacity of them or the descriptor type changes.
+    '''
+    def __init__(self,capacity=POOL_CAPACITY):
+        self._kp = [np.empty(capacity, KEYPOINT_DTYPE) for i in range(2)]
+        self._desc = [None, None]
+        self._next = 0
+
+    def _reserve(self,i,n,desc):
+        if n > len(self._kp[i]):
+            self._kp[i] = np.empty(max(n,2*len(self._kp[i])), KEYPOINT_DTYPE)
+        d = self._desc[i]
+        if d is None or len(d) < len(self._kp[i]) or d.shape[1:] != desc.shape[1:] or d.dtype != desc.dtype:
+            self._desc[i] = np.empty((len(self._kp[i]),)+desc.shape[1:], desc.dtype)
+
+    def fill(self,keypoints,descriptors,store,rows):
+        '''
+        Fill the next set of rows with keypoints and their descriptors
+        followed by the keypoints and descriptors of the store's tracks at
+        rows. Returns views of the filled rows.
+        '''
+        n, m = len(keypoints), len(rows)
+        if not m: return keypoints, descriptors
+        template = store.descriptors if descriptors is None else descriptors
+
+        i, self._next = self._next, self._next ^ 1
+        self._reserve(i, n+m, template)
+        kp, desc = self._kp[i][:n+m], self._desc[i][:n+m]
+        kp[:n] = keypoints
+        if n: desc[:n] = descriptors
+        store.keypoints(rows, out=kp[n:])
+        np.take(store.descriptors, rows, axis=0, out=desc[n:])
+        return kp, desc
@@ -0,0 +1,42 @@
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import unittest
+
+import numpy as np
+
+from matching import gatedKnnMatch
+
+
+class GatedKnnMatchTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.qdesc = rng.randn(3,16).astype(np.float32)
+        self.tdesc = rng.randn(4,16).astype(np.float32)
+
+    def test_single_candidate(self):
+        # query 0 has only train keypoint 2 within the radius
+        queryPts = [(100.,100.), (300.,300.), (500.,100.)]
+        trainPts = [(10.,400.), (400.,10.), (105.,100.), (590.,400.)]
+        for binary in (False, True):
+            qdesc, tdesc = self.qdesc, self.tdesc
+            if binary: qdesc, tdesc = (qdesc > 0).astype(np.uint8), (tdesc > 0).astype(np.uint8)
+            queryIdx, trainIdx, distance = gatedKnnMatch(qdesc, tdesc, queryPts, trainPts, 20., k=2, binary=binary)
+            self.assertEqual(list(queryIdx), [0])
+            self.assertEqual(list(trainIdx[0]), [2,-1])
+            self.assertTrue(np.isfinite(distance[0,0]))
+            self.assertTrue(np.isinf(distance[0,1]))
+
+    def test_brute_force(self):
+        # with a radius covering every keypoint the matches are brute force's
+        rng = np.random.RandomState(1)
+        qdesc, tdesc = rng.randn(50,16).astype(np.float32), rng.randn(60,16).astype(np.float32)
+        queryPts, trainPts = rng.uniform(0,100,(50,2)), rng.uniform(0,100,(60,2))
+        queryIdx, trainIdx, distance = gatedKnnMatch(qdesc, tdesc, queryPts, trainPts, 1000., k=2)
+        dist = np.sqrt(((qdesc[:,None].astype(np.float64)-tdesc)**2).sum(axis=2))
+        self.assertEqual(list(queryIdx), range(50))
+        self.assertTrue(np.array_equal(trainIdx, np.argsort(dist, axis=1)[:,:2]))
+        self.assertTrue(np.allclose(distance, np.sort(dist, axis=1)[:,:2], rtol=1e-5))
+
+
+if __name__ == '__main__':
+    unittest.main()